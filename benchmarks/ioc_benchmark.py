@@ -0,0 +1,320 @@
+#!/usr/bin/python
+"""Benchmarks of the injection overhead of dpy.
+
+  Every scenario runs a fresh copy of the ioc module and reports the best
+  per-operation time of a few repeats. The results are written as JSON so the
+  numbers of two commits can be compared:
+
+    python benchmarks/ioc_benchmark.py --output before.json
+    python benchmarks/ioc_benchmark.py --compare before.json
+"""
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, _ROOT)
+import ioc  # pylint: disable=g-import-not-at-top
+
+
+_SCENARIOS = []
+
+
+def Scenario(f):
+  """Registers a scenario returning a dict of benchmark names to timings."""
+  _SCENARIOS.append(f)
+  return f
+
+
+def _Time(f, number, repeat):
+  """Returns the best seconds per call of f out of repeat runs."""
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    for _ in xrange(number):
+      f()
+    elapsed = (time.time() - start) / number
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def _Fresh():
+  """Returns a freshly loaded ioc module."""
+  return reload(ioc)
+
+
+@Scenario
+def DirectVersusInjectedCall(number, repeat):
+  di = _Fresh()
+  di.Injectable.value(greet='Hello')
+  di.Injectable.value(user='Anonymous')
+
+  def Direct(greet='Hello', user='Anonymous'):
+    return greet, user
+
+  @di.Inject
+  def Injected(greet=di.IN, user=di.IN):
+    return greet, user
+
+  return {
+      'call.direct': _Time(Direct, number, repeat),
+      'call.injected': _Time(Injected, number, repeat),
+      'call.injected_overridden': _Time(
+          lambda: Injected(greet='Hi', user='Me'), number, repeat),
+  }
+
+
+@Scenario
+def DeepScopeStacks(number, repeat):
+  results = {}
+  for depth, size in ((1, 10), (10, 10), (10, 100)):
+    di = _Fresh()
+    container = di._DEFAULT_CONTAINER  # pylint: disable=protected-access
+
+    @di.Inject
+    def Injected(val=di.IN, root_val=di.IN):
+      return val, root_val
+
+    di.Injectable.value(root_val=0)
+    timings = {}
+
+    def Nest(level):
+      with di._Scope(container, None):
+        for i in range(size):
+          di.Injectable.value(**{'val_%d_%d' % (level, i): i})
+        if level == depth - 1:
+          di.Injectable.value(val=level)
+          timings['resolve'] = _Time(Injected, number, repeat)
+        else:
+          Nest(level + 1)
+
+    Nest(0)
+    results['scopes.resolve.depth%d_size%d' % (depth, size)] = (
+        timings['resolve'])
+  return results
+
+
+@Scenario
+def SingletonHits(number, repeat):
+  results = {}
+  for depth in (1, 10):
+    di = _Fresh()
+    container = di._DEFAULT_CONTAINER  # pylint: disable=protected-access
+
+    @di.Inject
+    def Get(singleton=di.IN):
+      return singleton
+
+    timings = {}
+
+    def Nest(level):
+      with di._Scope(container, None):
+        di.Injectable.value(val=level)
+        if level == depth - 1:
+
+          @di.Injectable
+          @di.Singleton
+          def singleton(val=di.IN):  # pylint: disable=unused-variable
+            return val
+
+          Get()
+          timings['hit'] = _Time(Get, number, repeat)
+        else:
+          Nest(level + 1)
+
+    Nest(0)
+    results['singleton.hit_depth%d' % depth] = timings['hit']
+  return results
+
+
+@Scenario
+def ScopePerRequest(number, repeat):
+  di = _Fresh()
+
+  @di.Injectable
+  def user(params=di.IN):  # pylint: disable=unused-variable
+    return params['user'][0] if 'user' in params else 'Anonymous'
+
+  @di.Injectable
+  def greet(params=di.IN):  # pylint: disable=unused-variable
+    return params['greet'][0] if 'greet' in params else 'Hello'
+
+  @di.Inject
+  def hello(greet=di.IN, app_name=di.IN, user=di.IN):
+    return '<p>%s: %s %s</p>' % (app_name, greet, user)
+
+  @di.Scope
+  def DoGet(params):
+    di.Injectable.value(params=params)
+    return hello()
+
+  di.Injectable.value(app_name='Hello dpy')
+  for i in range(200):
+    di.Injectable.value(**{'config_%d' % i: i})
+  params = {'user': ['Me']}
+  return {
+      'request.scope_per_request': _Time(
+          lambda: DoGet(params), number // 10, repeat),
+  }
+
+
+@Scenario
+def CapturedHandOff(number, repeat):
+  di = _Fresh()
+  di.Injectable.values(dict(('config_%d' % i, i) for i in range(10000)))
+
+  @di.Inject
+  def Task(params=di.IN, config_0=di.IN):
+    return params, config_0
+
+  @di.Scope
+  def DoGet(params):
+    di.Injectable.value(params=params)
+    return di.RunIn(di.Capture(), Task)
+
+  params = {'user': ['Me']}
+  return {
+      'request.capture_run_in_10k_values': _Time(
+          lambda: DoGet(params), number // 100, repeat),
+  }
+
+
+@Scenario
+def ValueRegistration(number, repeat):
+  di = _Fresh()
+  values = dict(('value_%d' % i, i) for i in range(12))
+
+  @di.Scope
+  def OneByOne():
+    for name, value in values.iteritems():
+      di.Injectable.value(**{name: value})
+
+  @di.Scope
+  def Batch():
+    di.Injectable.values(values)
+
+  return {
+      'values.register_12_one_by_one': _Time(OneByOne, number // 10, repeat),
+      'values.register_12_batch': _Time(Batch, number // 10, repeat),
+  }
+
+
+@Scenario
+def DeepDependencyGraphs(number, repeat):
+  di = _Fresh()
+  width, depth = 3, 6
+
+  def Provider(name, deps):
+    args = ', '.join('%s=di.IN' % dep for dep in deps)
+    namespace = {'di': di}
+    exec 'def %s(%s):\n  return 1' % (name, args) in namespace
+    return namespace[name]
+
+  previous = ['leaf']
+  for level in range(depth):
+    names = ['node_%d_%d' % (level, i) for i in range(width)]
+    for name in names:
+      di.Injectable(Provider(name, previous))
+    previous = names
+  di.Injectable(di.Singleton(Provider('top', previous)))
+
+  @di.Inject
+  def GetTop(top=di.IN):
+    return top
+
+  @di.Scope
+  def Request():
+    di.Injectable.value(leaf=1)
+    return GetTop()
+
+  return {
+      'graph.scoped_singleton': _Time(Request, number // 100, repeat),
+  }
+
+
+@Scenario
+def ContendedSingletons(number, repeat):
+  threads = 8
+
+  def FirstAccess():
+    di = _Fresh()
+
+    @di.Injectable
+    @di.Singleton
+    def singleton():  # pylint: disable=unused-variable
+      time.sleep(0.001)
+      return object()
+
+    @di.Inject
+    def Get(singleton=di.IN):
+      return singleton
+
+    workers = [threading.Thread(target=Get) for _ in range(threads)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+  return {
+      'singleton.first_access_%d_threads' % threads: _Time(
+          FirstAccess, max(1, number // 1000), repeat),
+  }
+
+
+def _Commit():
+  try:
+    return subprocess.Popen(
+        ['git', 'rev-parse', 'HEAD'], cwd=_ROOT, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE).communicate()[0].strip() or None
+  except OSError:
+    return None
+
+
+def Run(number, repeat):
+  """Runs all the scenarios and returns the report dict."""
+  benchmarks = {}
+  for scenario in _SCENARIOS:
+    benchmarks.update(scenario(number, repeat))
+  return {
+      'commit': _Commit(),
+      'python': platform.python_version(),
+      'number': number,
+      'repeat': repeat,
+      'seconds_per_op': benchmarks,
+  }
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('-n', '--number', type='int', default=100000,
+                    help='Calls per timing of the fast benchmarks.')
+  parser.add_option('-r', '--repeat', type='int', default=3,
+                    help='Timings per benchmark, the best one is reported.')
+  parser.add_option('-o', '--output', help='File to write the JSON report to.')
+  parser.add_option('-c', '--compare',
+                    help='JSON report to compare the results against.')
+  options, _ = parser.parse_args()
+
+  report = Run(options.number, options.repeat)
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+
+  if options.compare:
+    with open(options.compare) as f:
+      baseline = json.load(f)['seconds_per_op']
+    for name, seconds in sorted(report['seconds_per_op'].iteritems()):
+      if name in baseline:
+        print '%-45s %8.3fx' % (name, seconds / baseline[name])
+
+
+if __name__ == '__main__':
+  main()
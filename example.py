@@ -16,6 +16,7 @@ import ioc
 
 
 logging.basicConfig(level=logging.DEBUG)
+ioc.SetTracing()  # Log every injection.
 
 
 @ioc.Injectable
@@ -65,6 +66,7 @@ def main():
   # Creating global constant injectable
   ioc.Injectable.value(app_name='Hello dpy')
   ioc.Injectable.value(port=8000)
+  ioc.Validate(provided=('params',))  # params is injected by each request.
   ioc.Warmup()  # Start eager singletons
   ioc.DumpInjectionStack()  # Debug information
 
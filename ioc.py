@@ -17,17 +17,38 @@ Example:
   Hello()  # This will print 'Hello Anonymous'
 """
 import collections
+import cPickle
 import functools
 import inspect
+import itertools
 import logging
+import multiprocessing.util
+import operator
+import os
+import Queue
+import sys
 import threading
+import time
+import weakref
 
+try:
+  from concurrent import futures  # pylint: disable=g-import-not-at-top
+except ImportError:
+  futures = None
 
-_IN_TEST_MODE = False
-_TEST_SCOPE = None
+
+_TRACING = False
+_PROFILER = None
+_LAST_PROFILER = None
+_INSTRUMENTABLE_WRAPPERS = weakref.WeakKeyDictionary()
+
+_PROVIDER_INJECTIONS = weakref.WeakKeyDictionary()
 
 _MAIN_THREAD_ID = threading.currentThread().ident
-_DATA = threading.local()
+_PID = os.getpid()
+_FORK_LOCK = threading.Lock()
+
+_CONTAINERS = weakref.WeakKeyDictionary()
 
 
 class Error(Exception):
@@ -46,10 +67,18 @@ class TestInjectionsNotSetupError(Error):
   """When injection is requested without a set up test scope."""
 
 
+class ScopeFrozenError(Error):
+  """When an injectable is added to a frozen scope."""
+
+
+class InjectionGraphError(Error):
+  """When injectables are missing or depend on each other in a cycle."""
+
+
 class _InjectionSentinel(object):
   
   def _DO_NOT_USE_INJECTION_SENTINEL(self):
-    if _IN_TEST_MODE:
+    if any(container.in_test_mode for container in _CONTAINERS.keys()):
       raise TestInjectionsNotSetupError('Injection was expected in test mode!')
     raise InjectionNotPerformed('You forgot to mark something with @Inject or @Injectable.')
   
@@ -67,15 +96,155 @@ class _InjectionSentinel(object):
 
 
 IN = INJECTED = _InjectionSentinel()
+LAZY = _InjectionSentinel()
+
+
+class _LazyProxy(object):
+  """Stands in for a LAZY injection until it is first used.
+
+  The provider is called on the first use of the proxy, every use after that
+  goes straight to the provided value.
+
+  The proxy is never identical to the value: lazy is None is False even when
+  the provider returns None, and type(lazy) is _LazyProxy. Comparisons with ==
+  and isinstance checks do get forwarded to the value.
+  """
+  __slots__ = ('_ioc_provider', '_ioc_value')
+
+  def __init__(self, provider):
+    object.__setattr__(self, '_ioc_provider', provider)
+
+  def _ioc_Resolve(self):
+    try:
+      return object.__getattribute__(self, '_ioc_value')
+    except AttributeError:
+      value = object.__getattribute__(self, '_ioc_provider')()
+      object.__setattr__(self, '_ioc_value', value)
+      return value
+
+  @property
+  def __class__(self):
+    return self._ioc_Resolve().__class__
+
+  def __getattr__(self, name):
+    return getattr(self._ioc_Resolve(), name)
+
+  def __setattr__(self, name, value):
+    setattr(self._ioc_Resolve(), name, value)
+
+  def __delattr__(self, name):
+    delattr(self._ioc_Resolve(), name)
+
+  def __call__(self, *args, **kwargs):
+    return self._ioc_Resolve()(*args, **kwargs)
+
+  def __repr__(self):
+    return repr(self._ioc_Resolve())
+
+
+def _ForwardToLazyValue(name, op, reflected=False):
+  """Creates a special method of _LazyProxy applying op to the value."""
+  if reflected:
+    def Forward(self, other):
+      return op(other, self._ioc_Resolve())
+  else:
+    def Forward(self, *args):
+      return op(self._ioc_Resolve(), *args)
+  Forward.__name__ = name
+  return Forward
+
+
+for _name, _op in (
+    ('__str__', str), ('__unicode__', unicode), ('__nonzero__', bool),
+    ('__hash__', hash), ('__len__', len), ('__iter__', iter),
+    ('__int__', int), ('__long__', long), ('__float__', float),
+    ('__index__', operator.index), ('__neg__', operator.neg),
+    ('__pos__', operator.pos), ('__abs__', abs), ('__invert__', operator.inv),
+    ('__contains__', operator.contains), ('__getitem__', operator.getitem),
+    ('__setitem__', operator.setitem), ('__delitem__', operator.delitem),
+    ('__eq__', operator.eq), ('__ne__', operator.ne), ('__lt__', operator.lt),
+    ('__le__', operator.le), ('__gt__', operator.gt), ('__ge__', operator.ge),
+    ('__enter__', lambda value: value.__enter__()),
+    ('__exit__', lambda value, *args: value.__exit__(*args))):
+  setattr(_LazyProxy, _name, _ForwardToLazyValue(_name, _op))
+for _name, _op in (
+    ('add', operator.add), ('sub', operator.sub), ('mul', operator.mul),
+    ('div', operator.div), ('truediv', operator.truediv),
+    ('floordiv', operator.floordiv), ('mod', operator.mod),
+    ('pow', operator.pow), ('and', operator.and_), ('or', operator.or_),
+    ('xor', operator.xor), ('lshift', operator.lshift),
+    ('rshift', operator.rshift)):
+  setattr(_LazyProxy, '__%s__' % _name,
+          _ForwardToLazyValue('__%s__' % _name, _op))
+  setattr(_LazyProxy, '__r%s__' % _name,
+          _ForwardToLazyValue('__r%s__' % _name, _op, reflected=True))
+del _name, _op
+
+
+class _ConstantProvider(object):
+  """Provides an injectable value.
+
+  Injection plans read the value instead of calling the provider, see
+  _CompileInjectionPlan.
+  """
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __call__(self):
+    return self.value
+
+
+_TICKS = itertools.count()
+
+
+class _ManagedSingleton(object):
+  """The bookkeeping of a singleton with a SingletonPolicy in its scope.
+
+  Creations and injections are ordered by ticks of _TICKS, which unlike the
+  time never repeat.
+  """
+  __slots__ = ('policy', 'expires', 'created', 'used')
+
+  def __init__(self, policy):
+    self.policy = policy
+    self.expires = None if policy.ttl is None else time.time() + policy.ttl
+    self.created = self.used = next(_TICKS)
+
+
+class _Flight(object):
+  """A call of a SingleFlight injectable which concurrent injections share."""
+  __slots__ = ('done', 'value', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
 
 
 class _Scope(object):
 
-  def __init__(self, f):
+  def __init__(self, container, f, keys_of=None):
+    self.container = container
     self.func = f
+    self.keys_of = f if keys_of is None else keys_of
     self._gob = {}
     self._eagers = []
+    self._singleton_locks = {}
+    self._managed = {}
+    self._managed_lock = threading.Lock()
+    self._refreshing = set()
+    self._refresh_failures = {}
+    self._flights = {}
+    self._provider_keys = {}
     self.singletons = {}
+    self.refreshed = {}
+    self.scoped_values = {}
+    self.resumable = False
+    self.released = False
+    self.frozen = False
+    self.shared = True
 
   @property
   def name(self):
@@ -83,7 +252,7 @@ class _Scope(object):
       parent = (getattr(self.func, 'im_class', None) or
                 getattr(self.func, '__module__'))
       return '%s.%s' % (parent, self.func.__name__)
-    elif self is _ROOT_SCOPE:
+    elif self is self.container.root:
       return 'Root'
     else:
       return 'No Name'
@@ -92,13 +261,22 @@ class _Scope(object):
     """Adds a callable as an injectable to the scope.
 
     Args:
-      f: A callable to add as an injectable.
-      name: A name to give the injectable or None to use its name.
+      f: A callable to add as an injectable, or a _ConstantProvider.
+      name: A name to give the injectable or None to use its name. Required
+        for a _ConstantProvider.
     Returns:
       The wrapped injectable function.
+    Raises:
+      ScopeFrozenError: If the scope is frozen.
     """
-    _ResetInjectionScopeMap()
-    injected = _Inject(f)
+    if self.frozen:
+      raise ScopeFrozenError('Scope %r is frozen.' % self.name)
+    if isinstance(f, _ConstantProvider):
+      logging.debug('Value added as %r to scope %r.', name, self.name)
+      self._gob[name] = f
+      self.container._AddToInjectionScopeMap(self, name)
+      return f
+    injected = _Inject(self.container, f)
     if name:
       logging.debug('%r injectable added as %r to scope %r.',
                     injected.name, name, self.name)
@@ -106,12 +284,325 @@ class _Scope(object):
       logging.debug('%r injectable added to scope %r.',
                     injected.name, self.name)
       name = injected.name
-    injectable = injected.injectable_wrapper
+    injectable = injected.InjectableWrapper(name, self._ProviderKey(name))
     self._gob[name] = injectable
+    self.container._AddToInjectionScopeMap(self, name)
     if injected.eager:
-      self._eagers.append(injectable)
+      self._eagers.append((name, injectable))
     return injected.wrapper
 
+  def _ProviderKey(self, name):
+    """Returns the key of the values of the provider added as name.
+
+    Every run of a scope function shares the keys of its providers, so a
+    singleton added by each request which attached to an outer scope is found
+    again rather than created anew. So does every run of a task, see RunIn.
+    Other scopes without a function keep their own.
+
+    Args:
+      name: The name the provider is added as.
+    Returns:
+      The _ProviderKey.
+    """
+    keys = self._provider_keys
+    if self.keys_of is not None:
+      try:
+        keys = self.container._provider_keys.setdefault(self.keys_of, {})
+      except TypeError:
+        pass  # The function cannot be weakly referenced.
+    key = keys.get(name)
+    if key is None:
+      key = keys.setdefault(name, _ProviderKey(name))
+    return key
+
+  def InjectableValues(self, values):
+    """Adds injectable values to the scope at once.
+
+    Args:
+      values: A dict of the injectable names to their values.
+    Raises:
+      ScopeFrozenError: If the scope is frozen.
+      ValueError: If a name is already in use in the scope.
+    """
+    if self.frozen:
+      raise ScopeFrozenError('Scope %r is frozen.' % self.name)
+    for name in values:
+      if name in self._gob:
+        raise ValueError('Injectable %r already exist in scope %r.' %
+                         (name, self.name))
+    logging.debug('%d injectable values added to scope %r.',
+                  len(values), self.name)
+    for name, value in values.iteritems():
+      self._gob[name] = _ConstantProvider(value)
+    self.container._AddToInjectionScopeMap(self, *values)
+
+  def _CreateOnce(self, values, key, f, args, kwargs):
+    """Creates a value of the scope exactly once.
+
+    Concurrent creations of the same value wait for the first one, while
+    creations of other values proceed.
+
+    Args:
+      values: The dict of the scope to keep the value in.
+      key: The key of the value in values.
+      f: The callable creating the value.
+      args: Positional arguments for f.
+      kwargs: Keyword arguments for f.
+    Returns:
+      The value.
+    """
+    with self._GetLock(key):
+      if key not in values:
+        values[key] = f(*args, **kwargs)
+    return values[key]
+
+  def _GetLock(self, key):
+    try:
+      return self._singleton_locks[key]
+    except KeyError:
+      return self._singleton_locks.setdefault(key, threading.RLock())
+
+  def CreateSingleton(self, key, f, *args, **kwargs):
+    """Creates a singleton of the scope exactly once.
+
+    A singleton which is a future, e.g. of Tornado or concurrent.futures, is
+    shared by everyone waiting on it until it is done. It is dropped if it
+    fails, so the next injection creates it anew.
+    """
+    with self._GetLock(key):
+      if key in self.singletons:
+        return self.singletons[key]
+      value = self.singletons[key] = f(*args, **kwargs)
+    if callable(getattr(value, 'add_done_callback', None)):
+      value.add_done_callback(functools.partial(self._DropFailedSingleton,
+                                                key))
+    return value
+
+  def _DropFailedSingleton(self, key, future):
+    """Drops a singleton future once it failed, see CreateSingleton."""
+    if not future.cancelled() and future.exception() is None:
+      return
+    with self._GetLock(key):
+      if self.singletons.get(key) is future:
+        del self.singletons[key]
+        logging.debug('Singleton %r of scope %r failed, dropping it.', key,
+                      self.name)
+
+  def CreateScoped(self, key, f, *args, **kwargs):
+    """Creates a scoped value of the scope exactly once."""
+    return self._CreateOnce(self.scoped_values, key, f, args, kwargs)
+
+  def _GetManaged(self, key, evicted):
+    """Returns a managed singleton, the caller holds the _managed_lock.
+
+    Args:
+      key: The key of the singleton.
+      evicted: A list to add the singleton to if it has just expired, for the
+        caller to dispose of once it released its locks.
+    Returns:
+      The singleton.
+    Raises:
+      KeyError: If the singleton was evicted or has just expired.
+    """
+    managed = self._managed[key]
+    if managed.expires is None or time.time() < managed.expires:
+      managed.used = next(_TICKS)
+      return self.singletons[key]
+    evicted.append(self._Evict(key))
+    raise KeyError(key)
+
+  def GetManagedSingleton(self, key):
+    """Returns a singleton with a SingletonPolicy unless it was evicted.
+
+    Args:
+      key: The key of the singleton.
+    Returns:
+      The singleton.
+    Raises:
+      KeyError: If the singleton was evicted or has just expired.
+    """
+    evicted = []
+    try:
+      with self._managed_lock:
+        return self._GetManaged(key, evicted)
+    finally:
+      self._Dispose(evicted)
+
+  def CreateManagedSingleton(self, key, policy, f, *args, **kwargs):
+    """Creates a singleton with a SingletonPolicy unless it already exists.
+
+    The least recently injected singletons of the policy are evicted if there
+    are more than its max_size. Evicted singletons are disposed of once the
+    lock of the key is released, so disposing does not hold up injections.
+
+    A singleton created after the scope was released, by a callable captured
+    in it, is kept by the innermost scope of the thread instead, which
+    disposes of it once the callable returns, see RunIn.
+    """
+    evicted = []
+    try:
+      with self._GetLock(key):
+        try:
+          with self._managed_lock:
+            return self._GetManaged(key, evicted)
+        except KeyError:
+          pass
+        value = f(*args, **kwargs)
+        with self._managed_lock:
+          if not self.released:
+            self._AddManaged(key, policy, value, evicted)
+            return value
+      scope = self.container._CurrentScope()
+      logging.debug('Scope %r was released, attaching singleton %r to %r.',
+                    self.name, key, scope.name)
+      with scope._managed_lock:
+        scope._AddManaged(key, policy, value, evicted)
+      return value
+    finally:
+      self._Dispose(evicted)
+
+  def _AddManaged(self, key, policy, value, evicted):
+    """Adds a managed singleton, the caller holds the _managed_lock."""
+    self.singletons[key] = value
+    self._managed[key] = _ManagedSingleton(policy)
+    if policy.max_size is not None:
+      keys = [k for k, managed in self._managed.iteritems()
+              if managed.policy is policy]
+      keys.sort(key=lambda k: self._managed[k].used)
+      for k in keys[:max(0, len(keys) - policy.max_size)]:
+        evicted.append(self._Evict(k))
+
+  def RefreshSingleton(self, key, refreshed, f, *args, **kwargs):
+    """Creates a refreshing singleton anew and publishes it.
+
+    Concurrent refreshes of the same singleton wait for the first one, and do
+    not create it again if it was refreshed meanwhile. Injections keep getting
+    the previous singleton until the new one is published.
+
+    Args:
+      key: The key of the singleton.
+      refreshed: The time the singleton was refreshed at according to the
+        caller, or None if it was not created yet.
+      f: The callable creating the singleton.
+      *args: Positional arguments for f.
+      **kwargs: Keyword arguments for f.
+    Returns:
+      The singleton.
+    """
+    with self._GetLock(key):
+      if self.refreshed.get(key) == refreshed:
+        value = f(*args, **kwargs)
+        self.refreshed[key] = time.time()
+        self.singletons[key] = value
+      return self.singletons[key]
+
+  def RefreshSingletonInBackground(self, key, refreshed, interval, f, *args,
+                                  **kwargs):
+    """Refreshes a singleton on a thread unless it is already being refreshed.
+
+    The thread runs in the scopes of the current thread, see Capture. When the
+    refresh fails, the previous singleton is kept and the refresh is not tried
+    again before interval passed.
+
+    Args:
+      key: The key of the singleton.
+      refreshed: The time the singleton was refreshed at according to the
+        caller.
+      interval: The seconds to wait after a failed refresh.
+      f: The callable creating the singleton.
+      *args: Positional arguments for f.
+      **kwargs: Keyword arguments for f.
+    """
+    with self._managed_lock:
+      if key in self._refreshing:
+        return
+      failed = self._refresh_failures.get(key)
+      if failed is not None and time.time() - failed < interval:
+        return
+      self._refreshing.add(key)
+    captured = self.container.Capture()
+
+    def Refresh():
+      failed = None
+      try:
+        self.container.RunIn(captured, self.RefreshSingleton, key, refreshed,
+                             f, *args, **kwargs)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Refreshing singleton %r failed.', key)
+        failed = time.time()
+      finally:
+        with self._managed_lock:
+          self._refreshing.discard(key)
+          if failed is None:
+            self._refresh_failures.pop(key, None)
+          else:
+            self._refresh_failures[key] = failed
+
+    thread = threading.Thread(target=Refresh,
+                              name='ioc refresh of %s' % key.name)
+    thread.daemon = True
+    thread.start()
+
+  def CallSingleFlight(self, key, f):
+    """Calls f unless a call of the same key is running, then waits for it.
+
+    Args:
+      key: The key of the call.
+      f: The callable to call.
+    Returns:
+      The return value of the call.
+    Raises:
+      Exception: The error the call raised, raised in every waiting thread.
+    """
+    with self._managed_lock:
+      flight = self._flights.get(key)
+      running = flight is not None
+      if not running:
+        flight = self._flights[key] = _Flight()
+    if running:
+      flight.done.wait()
+    else:
+      try:
+        flight.value = f()
+      except:  # pylint: disable=bare-except
+        flight.error = sys.exc_info()
+      finally:
+        with self._managed_lock:
+          del self._flights[key]
+        flight.done.set()
+    if flight.error:
+      raise flight.error[0], flight.error[1], flight.error[2]
+    return flight.value
+
+  def _Evict(self, key):
+    """Removes a managed singleton, the caller holds the _managed_lock."""
+    managed = self._managed.pop(key)
+    return key, managed.policy, self.singletons.pop(key)
+
+  def _Dispose(self, evicted):
+    for key, policy, value in evicted:
+      logging.debug('Evicting singleton %r from scope %r.', key, self.name)
+      if policy.dispose is None:
+        continue
+      try:
+        policy.dispose(value)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Disposing singleton %r failed.', key)
+
+  def Release(self):
+    """Releases the values scoped to the scope once it is left for good.
+
+    The singletons with a SingletonPolicy are disposed of, the most recently
+    created first.
+    """
+    self.scoped_values.clear()
+    with self._managed_lock:
+      self.released = True
+      keys = sorted(self._managed, key=lambda k: self._managed[k].created,
+                    reverse=True)
+      evicted = [self._Evict(key) for key in keys]
+    self._Dispose(evicted)
+
   def __contains__(self, name):
     return name in self._gob
 
@@ -121,11 +612,25 @@ class _Scope(object):
   def __iter__(self):
     return iter(self._gob)
 
-  def Warmup(self):
+  def Warmup(self, parallel=None):
+    """Instantiates the eager singletons of the scope.
+
+    Args:
+      parallel: The number of threads instantiating independent eager
+        singletons at the same time, or None to instantiate them one after
+        another in registration order.
+    Returns:
+      A dict of the seconds it took to instantiate each eager singleton.
+    """
     logging.debug('Warming up: %s', self.name)
-    for eager in self._eagers:
-      eager()
+    if parallel:
+      timings = _WarmupInParallel(self.container, self._eagers, parallel)
+    else:
+      timings = {}
+      for name, eager in self._eagers:
+        timings[name] = _TimeWarmup(name, eager)
     logging.debug('Hot: %s', self.name)
+    return timings
 
   def __str__(self):
     a = ['Scope %r:' % self.name]
@@ -137,103 +642,210 @@ class _Scope(object):
     return ''.join(a)
 
   def __enter__(self):
-    scopes = _MyScopes()
-    if threading.currentThread().ident == _MAIN_THREAD_ID:
-      _BASE_SCOPES.append(self)
-    else:
-      scopes.append(self)
+    # Scopes of the main thread are inherited by the threads it starts, its
+    # scope stack is the base scopes of the container unless it runs in
+    # captured scopes.
+    self.shared = threading.currentThread().ident == _MAIN_THREAD_ID
+    self.container._EnterScope(self)
 
   def __exit__(self, t, v, tb):
-    _ResetInjectionScopeMap()
-    _MyScopes().pop()
+    self.container._ExitScope(self)
+    if not self.resumable:
+      self.Release()
 
 
-_ROOT_SCOPE = _Scope(None)  # Create Root scope
-_BASE_SCOPES = [_ROOT_SCOPE]
-_DATA.scopes = _BASE_SCOPES
+InjectionScope = collections.namedtuple('InjectionScope',
+                                        ['idx', 'scope', 'callable'])
 
 
-def _MyScopes():
-  if not hasattr(_DATA, 'scopes'):
-    _DATA.scopes = _BASE_SCOPES[:]
-  return _DATA.scopes
+class _InjectionScopeMap(object):
+  """The injectables visible from the scope stack of a thread.
 
+  Each name maps to the InjectionScope of its nearest provider, where idx is
+  the position of the providing scope counting from the root. The entries of
+  the root scope are kept apart from those of the scopes above it. Every layer
+  above the root remembers the entries its own injectables shadow, so entering
+  or leaving a scope and adding an injectable to the current scope only touch
+  the names of that scope.
 
-def _CurrentScope():
-  return _MyScopes()[-1]
+  The map also caches the scope holding each singleton found, until the scope
+  is left, and the names each tuple of injections transitively depends on,
+  until one of these names is shadowed or restored.
 
+  The map is only valid while its generation is the one of its container, see
+  Container._NewGeneration.
+  """
 
-def _ResetInjectionScopeMap():
-  """Delete the injection_scope_map to force the recalculate."""
-  if hasattr(_DATA, 'injection_scope_map'):
-    del _DATA.injection_scope_map
+  def __init__(self, scopes, generation, frozen_injections=None):
+    """Creates the map of a scope stack.
 
+    Args:
+      scopes: The scope stack, starting with the root scope.
+      generation: The generation of the container.
+      frozen_injections: The entries of the root scope once frozen, see
+        Container.Freeze, or None to compute them from the root scope.
+    """
+    self.generation = generation
+    self._root = {}
+    self._root_shared = False
+    self._upper = {}
+    self._shadowed = []
+    self.singleton_scopes = {}
+    self._singleton_keys = []
+    self.plans = {}
+    self.dependencies = {}
+    self.dep_scopes = {}
+    self._dependents = {}
+    self._caches_shared = False
+    for idx, scope in enumerate(scopes):
+      self.Push()
+      if idx == 0 and frozen_injections is not None:
+        self._root, self._root_shared = frozen_injections, True
+      else:
+        self.Add(scope, *scope)
 
-InjectionScope = collections.namedtuple('InjectionScope',
-                                        ['idx', 'scope', 'callable'])
+  def _Invalidate(self, names):
+    """Drops what was computed from the entries of the names.
 
+    The plans are all dropped. The dependencies, and the singleton scopes
+    computed from them, are only dropped when they include one of the names.
+    """
+    self.plans = {}
+    if self._caches_shared:
+      self.dependencies, self.dep_scopes, self._dependents = {}, {}, {}
+      self._caches_shared = False
+      return
+    for name in names:
+      for injections in self._dependents.pop(name, ()):
+        self.dependencies.pop(injections, None)
+        self.dep_scopes.pop(injections, None)
+
+  def AddDependencies(self, injections, dependencies):
+    """Caches the names the injections depend on until one of them changes."""
+    self.dependencies[injections] = dependencies
+    for name in dependencies:
+      try:
+        self._dependents[name].add(injections)
+      except KeyError:
+        self._dependents[name] = set([injections])
+
+  def Push(self):
+    self._shadowed.append({})
+    self._singleton_keys.append([])
+
+  def Pop(self):
+    for key in self._singleton_keys.pop():
+      self.singleton_scopes.pop(key, None)
+    shadowed = self._shadowed.pop()
+    if not shadowed:
+      return
+    self._Invalidate(shadowed)
+    for name, entry in shadowed.iteritems():
+      if entry is None:
+        del self._upper[name]
+      else:
+        self._upper[name] = entry
 
-def _GetCurrentInjectionInfo():
-  """Returns a dict contains the required injections' information.
+  def Copy(self):
+    """Returns a copy of the map.
 
-  This method is used to provide information for filling injection and
-  calculating scope dependency.
-  """
-  if not hasattr(_DATA, 'injection_scope_map'):
-    injection_scope_map = {}
-    for idx, scope in enumerate(reversed(_MyScopes())):
-      for injection in scope:
-        if injection not in injection_scope_map:
-          injection_scope_map[injection] = InjectionScope(idx, scope,
-                                                          scope[injection])
-    _DATA.injection_scope_map = injection_scope_map
-  return _DATA.injection_scope_map
-
-
-def _FillInInjections(injections, arguments):
-  injection_scope_map = _GetCurrentInjectionInfo()
-
-  for injection in injections:
-    if injection in arguments: continue
+    Only the entries above the root are copied. The root entries and the
+    cached plans and dependencies are shared until either map changes.
+    """
+    scope_map = object.__new__(_InjectionScopeMap)
+    scope_map.generation = self.generation
+    scope_map._root = self._root
+    scope_map._root_shared = self._root_shared = True
+    scope_map._upper = self._upper.copy()
+    scope_map._shadowed = [shadowed.copy() for shadowed in self._shadowed]
+    scope_map.plans = self.plans
+    scope_map.dependencies = self.dependencies
+    scope_map.dep_scopes = self.dep_scopes
+    scope_map._dependents = self._dependents
+    scope_map._caches_shared = self._caches_shared = True
+    scope_map.singleton_scopes = {}
+    scope_map._singleton_keys = [[] for _ in self._shadowed]
+    return scope_map
+
+  def AddSingletonScope(self, key, idx, scope):
+    """Remembers the scope at position idx holds the singleton of key."""
+    self.singleton_scopes[key] = scope
+    self._singleton_keys[idx].append(key)
+
+  def Add(self, scope, *names):
+    """Adds injectables of the scope on top of the stack to the map."""
+    self._Invalidate(names)
+    idx = len(self._shadowed) - 1
+    if not idx:
+      if self._root_shared:
+        self._root, self._root_shared = self._root.copy(), False
+      for name in names:
+        self._root[name] = InjectionScope(idx, scope, scope[name])
+      return
+    shadowed = self._shadowed[-1]
+    for name in names:
+      if name not in shadowed:
+        shadowed[name] = self._upper.get(name)
+      self._upper[name] = InjectionScope(idx, scope, scope[name])
+
+  def __contains__(self, name):
+    return name in self._upper or name in self._root
+
+  def __getitem__(self, name):
     try:
-      if _IN_TEST_MODE:
-        if _TEST_SCOPE is None:
-          raise TestInjectionsNotSetupError(
-              'Test injections have not been setup.')
-        arguments[injection] = _TEST_SCOPE[injection]()
-      else:
-        arguments[injection] = injection_scope_map[injection].callable()
+      return self._upper[name]
     except KeyError:
-      raise InjectionMissingError(
-          'The injectable named %r was not found.' % injection)
+      return self._root[name]
 
+  def get(self, name, default=None):  # pylint: disable=invalid-name
+    try:
+      return self[name]
+    except KeyError:
+      return default
 
-def _CalculateScopeDep(injections):
-  """Returns the deepest required scope inside the current scope tree."""
-  dep_scope_idx, dep_scope = len(_MyScopes()), _MyScopes()[0]  # root scope.
-  injection_scope_map = _GetCurrentInjectionInfo()
+  def __iter__(self):
+    for name in self._upper:
+      yield name
+    for name in self._root:
+      if name not in self._upper:
+        yield name
 
-  injection_queue = collections.deque(injections)
-  while injection_queue:
-    injection = injection_queue.popleft()
-    if injection not in injection_scope_map:
-      raise ValueError('The injectable named %r was not found.' % injection)
+  def iteritems(self):  # pylint: disable=invalid-name
+    for name in self:
+      yield name, self[name]
 
-    idx, scope, callable_func = injection_scope_map[injection]
 
-    # Get all injections and put into queue.
-    while hasattr(callable_func, 'ioc_wrapper'):
-      callable_func = callable_func.ioc_wrapper  # Get the original callable.
-    if inspect.isclass(callable_func):
-      argspec = inspect.getargspec(callable_func.__init__)
-    else:
-      argspec = inspect.getargspec(callable_func)
-    injection_queue.extend(_GetInjections(argspec))
+def _CreateRaiser(error_class, message):
+  """Creates a provider which raises the given error when called."""
+  def Raiser():
+    raise error_class(message)
+  return Raiser
 
-    if idx < dep_scope_idx:
-      dep_scope_idx, dep_scope = idx, scope
 
-  return dep_scope
+def _GetProviderArgspec(provider):
+  """Returns the argspec of the original callable behind a provider."""
+  original = provider
+  while hasattr(original, 'ioc_wrapper'):
+    original = original.ioc_wrapper  # Get the original callable.
+  if inspect.isclass(original):
+    return inspect.getargspec(original.__init__)
+  return inspect.getargspec(original)
+
+
+def _GetProviderInjections(provider):
+  """Returns the injections of the original callable behind a provider.
+
+  The injections are computed once per provider.
+  """
+  if isinstance(provider, _ConstantProvider):
+    return ()
+  try:
+    return _PROVIDER_INJECTIONS[provider]
+  except KeyError:
+    pass
+  injections = _PROVIDER_INJECTIONS[provider] = _GetInjections(
+      _GetProviderArgspec(provider))
+  return injections
 
 
 def _GetInjections(argspec):
@@ -241,41 +853,458 @@ def _GetInjections(argspec):
     return tuple()
   injections = argspec.args[-len(argspec.defaults):]
   injections = tuple(injection for i, injection in enumerate(injections)
-                     if argspec.defaults[i] is INJECTED)
+                     if argspec.defaults[i] is INJECTED or
+                     argspec.defaults[i] is LAZY)
   return injections
 
 
-def _CreateInjectWrapper(f, injections):
+def _GetLazyInjections(argspec):
+  """Returns the names of the arguments to inject lazily."""
+  if not argspec.defaults:
+    return frozenset()
+  injections = argspec.args[-len(argspec.defaults):]
+  return frozenset(injection for i, injection in enumerate(injections)
+                   if argspec.defaults[i] is LAZY)
+
+
+def _GetRequiredInjections(injection_scope_map, injections, lazy):
+  """Returns the names the injections depend on through IN injections only.
+
+  Args:
+    injection_scope_map: The injection scope map to resolve the names in.
+    injections: A tuple of injection names.
+    lazy: The names of the injections which are injected lazily.
+  Returns:
+    A set of the names, which are required for the injections to be made.
+  """
+  required = set()
+  injection_queue = collections.deque(
+      injection for injection in injections if injection not in lazy)
+  while injection_queue:
+    injection = injection_queue.popleft()
+    if injection in required:
+      continue
+    required.add(injection)
+    if injection not in injection_scope_map:
+      continue
+    provider = injection_scope_map[injection].callable
+    provider_injections = _GetProviderInjections(provider)
+    if provider_injections:
+      provider_lazy = _GetLazyInjections(_GetProviderArgspec(provider))
+      injection_queue.extend(dep for dep in provider_injections
+                             if dep not in provider_lazy)
+  return required
+
+
+def _Instrumentable(f, wrapper, instrumented_wrapper):
+  """Sets up an injection wrapper which can be swapped for an instrumented one.
+
+  Both versions must close over the same variables. The wrapper runs the code
+  of the instrumented version while tracing or profiling is enabled, see
+  SetTracing and StartProfiling.
+
+  Args:
+    f: The wrapped callable.
+    wrapper: The wrapper without any logging or profiling.
+    instrumented_wrapper: The same wrapper with logging and profiling.
+  Returns:
+    The wrapper.
+  """
+  # The code reads the closure cells by position, so swapping the code of
+  # closures over other variables would silently read the wrong cells.
+  assert wrapper.__code__.co_freevars == (
+      instrumented_wrapper.__code__.co_freevars), (
+          'Injection wrappers must close over the same variables.')
+  _INSTRUMENTABLE_WRAPPERS[wrapper] = (wrapper.__code__,
+                                       instrumented_wrapper.__code__)
+  if _TRACING or _PROFILER is not None:
+    wrapper.__code__ = instrumented_wrapper.__code__
+  functools.update_wrapper(wrapper, f)
+  wrapper.ioc_wrapper = f
+  return wrapper
+
+
+def _SwapInstrumentation():
+  """Swaps all wrappers to match whether tracing or profiling is enabled."""
+  instrumented = _TRACING or _PROFILER is not None
+  for wrapper, (code, instrumented_code) in _INSTRUMENTABLE_WRAPPERS.items():
+    wrapper.__code__ = instrumented_code if instrumented else code
+
+
+def _TraceInjection(f, injections):
+  if _TRACING:
+    logging.debug('Injecting %r with %r', f.__name__, injections)
+
+
+_INJECT_WRAPPER_TEMPLATE = """def Wrapper(%(params)s):
+%(trace)s  _ioc_plan = %(container)s._ResolveInjectionPlan(_ioc_f, _ioc_injections)
+%(fill)s  return _ioc_f(%(args)s)
+"""
+_INJECT_WRAPPER_TRACE = """\
+  _ioc_TraceInjection(_ioc_f, _ioc_injections)
+"""
+_INJECT_WRAPPER_FILL = """\
+  if %(name)s is _ioc_IN:
+    %(name)s = _ioc_plan[%(idx)d][1]()
+"""
+_INJECT_WRAPPER_FILL_LAZY = """\
+  if %(name)s is _ioc_LAZY:
+    %(name)s = _ioc_LazyProxy(_ioc_plan[%(idx)d][1])
+"""
+_INJECT_WRAPPER_PROFILED_FILL = """\
+  if %(name)s is _ioc_IN:
+    %(name)s = %(container)s._CallProvider(*_ioc_plan[%(idx)d])
+"""
+_INJECT_WRAPPER_PROFILED_FILL_LAZY = """\
+  if %(name)s is _ioc_LAZY:
+    %(name)s = _ioc_LazyProxy(
+        _ioc_partial(%(container)s._CallProvider, *_ioc_plan[%(idx)d]))
+"""
+
+
+def _GenerateInjectWrappers(container, f, injections):
+  """Generates an injection wrapper specialized to the signature of f.
+
+  The generated wrapper takes the same arguments as f and only calls the
+  providers of the injected arguments which were not given. LAZY arguments
+  get a proxy calling the provider on first use. Wrappers of the default
+  container look it up when called, see _GetBoundContainer.
+
+  Args:
+    container: The Container to inject from.
+    f: The callable to inject into.
+    injections: A tuple of the injection names of f.
+  Returns:
+    A pair of the wrapper and its instrumented version, or None if the
+    signature of f cannot be reproduced.
+  """
+  if inspect.ismethod(f) and f.__self__ is not None:
+    return None  # The argspec of a bound method includes self or cls.
+  try:
+    argspec = inspect.getargspec(f)
+  except TypeError:
+    return None
+  names = argspec.args + [name for name in (argspec.varargs, argspec.keywords)
+                          if name]
+  for name in names:
+    if not isinstance(name, str) or name.startswith('_ioc_'):
+      return None  # Nested tuple arguments or a clash with our names.
+
+  params = list(argspec.args)
+  for i in range(len(argspec.defaults or ())):
+    params[-1 - i] += '=None'  # The real defaults are set below.
+  args = list(argspec.args)
+  if argspec.varargs:
+    params.append('*' + argspec.varargs)
+    args.append('*' + argspec.varargs)
+  if argspec.keywords:
+    params.append('**' + argspec.keywords)
+    args.append('**' + argspec.keywords)
+  lazy = _GetLazyInjections(argspec)
+  bound = _GetBoundContainer(container)
+
+  namespace = {
+      '_ioc_f': f,
+      '_ioc_injections': injections,
+      '_ioc_IN': INJECTED,
+      '_ioc_LAZY': LAZY,
+      '_ioc_LazyProxy': _LazyProxy,
+      '_ioc_container': bound,
+      '_ioc_module': sys.modules[__name__],
+      '_ioc_TraceInjection': _TraceInjection,
+      '_ioc_partial': functools.partial,
+  }
+  if bound is None:
+    container_source = '_ioc_module._DEFAULT_CONTAINER'
+  else:
+    container_source = '_ioc_container'
+  wrappers = []
+  for trace, fill_template, lazy_fill_template in (
+      ('', _INJECT_WRAPPER_FILL, _INJECT_WRAPPER_FILL_LAZY),
+      (_INJECT_WRAPPER_TRACE, _INJECT_WRAPPER_PROFILED_FILL,
+       _INJECT_WRAPPER_PROFILED_FILL_LAZY)):
+    fill = ''.join(
+        (lazy_fill_template if name in lazy else fill_template) %
+        {'name': name, 'idx': idx, 'container': container_source}
+        for idx, name in enumerate(injections))
+    source = _INJECT_WRAPPER_TEMPLATE % {
+        'params': ', '.join(params), 'trace': trace, 'fill': fill,
+        'args': ', '.join(args), 'container': container_source}
+    exec(compile(source, '<ioc wrapper of %s>' % f.__name__, 'exec'),
+         namespace)
+    wrapper = namespace.pop('Wrapper')
+    wrapper.__defaults__ = argspec.defaults
+    wrappers.append(wrapper)
+  return wrappers
+
+
+def _GetBoundContainer(container):
+  """Returns the container for injection wrappers to bind.
+
+  The default container is bound as None, which the wrappers resolve to the
+  default container when called. Callables decorated before reload(ioc)
+  therefore inject from the new default container, like they did before
+  there were containers.
+
+  Args:
+    container: The Container injecting.
+  Returns:
+    The container, or None for the default container.
+  """
+  return None if container is _DEFAULT_CONTAINER else container
+
+
+def _CreateInjectWrapper(container, f, injections):
   if not injections:
     return f
 
-  @functools.wraps(f)
+  wrappers = _GenerateInjectWrappers(container, f, injections)
+  if wrappers:
+    return _Instrumentable(f, *wrappers)
+  lazy = _GetLazyInjections(inspect.getargspec(f))
+  bound = _GetBoundContainer(container)
+
   def Wrapper(*args, **kwargs):
-    logging.debug('Injecting %r with %r - %r', f.__name__, injections, kwargs)
-    _FillInInjections(injections, kwargs)
+    container = bound or _DEFAULT_CONTAINER
+    container._FillInInjections(f, injections, kwargs, lazy)
     return f(*args, **kwargs)
-  Wrapper.ioc_wrapper = f
-  return Wrapper
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if _TRACING:
+      logging.debug('Injecting %r with %r - %r', f.__name__, injections, kwargs)
+    container._FillInInjections(f, injections, kwargs, lazy,
+                                call=container._CallProvider)
+    return f(*args, **kwargs)
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
 
 
-def _CreateSingletonInjectableWrapper(f, injections):
+class _ProviderKey(object):
+  """Identifies the values a provider created in the scopes.
+
+  Providers added under different names or by different scopes get their own
+  keys, so providers sharing a function name never share their values. The
+  runs of one scope function share the key of a name, see _Scope._ProviderKey.
+  """
+  __slots__ = ('name',)
+
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return '<ioc provider %r>' % self.name
+
+
+def _CreateSingletonInjectableWrapper(container, f, injections, key,
+                                      fingerprint=None):
+  bound = _GetBoundContainer(container)
+  lazy = _GetLazyInjections(_GetProviderArgspec(f))
 
-  @functools.wraps(f)
   def Wrapper(*args, **kwargs):
-    logging.debug(
-        'Injecting singleton %r with %r - %r', f.__name__, injections, kwargs)
-    for scope in _MyScopes():
-      if f.__name__ in scope.singletons:
-        return scope.singletons[f.__name__]
+    container = bound or _DEFAULT_CONTAINER
+    try:
+      scope = container._GetInjectionScopeMap().singleton_scopes[key]
+      return scope.singletons[key]
+    except KeyError:
+      pass
+    scope = container._FindSingletonScope(key)
+    if scope is not None:
+      return scope.singletons[key]
 
     # Couldn't find it in current scope tree.
-    dep_scope = _CalculateScopeDep(injections)
-    dep_scope.singletons[f.__name__] = f(*args, **kwargs)
-    logging.debug(
-        'Attaching singleton %r to scope %s', f.__name__, dep_scope.name)
-    return dep_scope.singletons[f.__name__]
-  Wrapper.ioc_wrapper = f
-  return Wrapper
+    dep_scope = container._CalculateScopeDep(injections, lazy)
+    return dep_scope.CreateSingleton(key, f, *args, **kwargs)
+
+  Wrapper.ioc_singleton_key = key
+  if fingerprint is not None:
+    Wrapper.ioc_singleton_fingerprint = fingerprint
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if _TRACING:
+      logging.debug(
+          'Injecting singleton %r with %r - %r', key.name, injections, kwargs)
+    profiler = _PROFILER
+    scope = container._FindSingletonScope(key)
+    if scope is not None:
+      if profiler:
+        profiler.CountSingleton(
+            key.name, container._GetProfiledScopeName(key.name), hit=True)
+      return scope.singletons[key]
+
+    # Couldn't find it in current scope tree.
+    dep_scope = container._CalculateScopeDep(injections, lazy)
+    if _TRACING:
+      logging.debug(
+          'Attaching singleton %r to scope %s', key.name, dep_scope.name)
+    if profiler:
+      profiler.CountSingleton(
+          key.name, container._GetProfiledScopeName(key.name), hit=False)
+    return dep_scope.CreateSingleton(key, f, *args, **kwargs)
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
+
+
+def _CreateManagedSingletonInjectableWrapper(container, f, injections, key,
+                                             policy):
+  bound = _GetBoundContainer(container)
+  lazy = _GetLazyInjections(_GetProviderArgspec(f))
+
+  def Wrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    scope = container._FindSingletonScope(key)
+    if scope is not None:
+      try:
+        return scope.GetManagedSingleton(key)
+      except KeyError:
+        pass  # Evicted.
+
+    dep_scope = container._CalculateScopeDep(injections, lazy)
+    return dep_scope.CreateManagedSingleton(key, policy, f, *args, **kwargs)
+
+  Wrapper.ioc_singleton_key = key
+  Wrapper.ioc_singleton_policy = policy
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if _TRACING:
+      logging.debug(
+          'Injecting singleton %r with %r - %r', key.name, injections, kwargs)
+    profiler = _PROFILER
+    scope = container._FindSingletonScope(key)
+    if scope is not None:
+      try:
+        singleton = scope.GetManagedSingleton(key)
+      except KeyError:
+        pass  # Evicted.
+      else:
+        if profiler:
+          profiler.CountSingleton(
+              key.name, container._GetProfiledScopeName(key.name), hit=True)
+        return singleton
+
+    dep_scope = container._CalculateScopeDep(injections, lazy)
+    if _TRACING:
+      logging.debug(
+          'Attaching singleton %r to scope %s', key.name, dep_scope.name)
+    if profiler:
+      profiler.CountSingleton(
+          key.name, container._GetProfiledScopeName(key.name), hit=False)
+    return dep_scope.CreateManagedSingleton(key, policy, f, *args, **kwargs)
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
+
+
+def _CreateRefreshingSingletonInjectableWrapper(container, f, injections, key,
+                                                refresh):
+  bound = _GetBoundContainer(container)
+  lazy = _GetLazyInjections(_GetProviderArgspec(f))
+
+  def Wrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    scope = container._FindSingletonScope(key)
+    if scope is None:
+      dep_scope = container._CalculateScopeDep(injections, lazy)
+      return dep_scope.RefreshSingleton(key, None, f, *args, **kwargs)
+    refreshed = scope.refreshed[key]
+    age = time.time() - refreshed
+    if age < refresh.interval:
+      return scope.singletons[key]
+    if refresh.stale_ok is not None and (
+        age >= refresh.interval + refresh.stale_ok):
+      return scope.RefreshSingleton(key, refreshed, f, *args, **kwargs)
+    scope.RefreshSingletonInBackground(key, refreshed, refresh.interval, f,
+                                       *args, **kwargs)
+    return scope.singletons[key]
+
+  Wrapper.ioc_singleton_key = key
+  Wrapper.ioc_singleton_refresh = refresh
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if _TRACING:
+      logging.debug(
+          'Injecting singleton %r with %r - %r', key.name, injections, kwargs)
+    profiler = _PROFILER
+    scope = container._FindSingletonScope(key)
+    if scope is None:
+      dep_scope = container._CalculateScopeDep(injections, lazy)
+      if profiler:
+        profiler.CountSingleton(
+            key.name, container._GetProfiledScopeName(key.name), hit=False)
+      return dep_scope.RefreshSingleton(key, None, f, *args, **kwargs)
+    refreshed = scope.refreshed[key]
+    age = time.time() - refreshed
+    if profiler:
+      profiler.CountSingleton(
+          key.name, container._GetProfiledScopeName(key.name), hit=True)
+    if age < refresh.interval:
+      return scope.singletons[key]
+    if _TRACING:
+      logging.debug('Refreshing singleton %r of scope %s', key.name,
+                    scope.name)
+    if refresh.stale_ok is not None and (
+        age >= refresh.interval + refresh.stale_ok):
+      return scope.RefreshSingleton(key, refreshed, f, *args, **kwargs)
+    scope.RefreshSingletonInBackground(key, refreshed, refresh.interval, f,
+                                       *args, **kwargs)
+    return scope.singletons[key]
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
+
+
+def _CreateScopedInjectableWrapper(container, f, key):
+  bound = _GetBoundContainer(container)
+
+  def Wrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    scope = container._CurrentScope()
+    try:
+      return scope.scoped_values[key]
+    except KeyError:
+      return scope.CreateScoped(key, f, *args, **kwargs)
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    scope = container._CurrentScope()
+    if _TRACING:
+      logging.debug('Injecting scoped %r in scope %s - %r',
+                    key.name, scope.name, kwargs)
+    profiler = _PROFILER
+    hit = key in scope.scoped_values
+    if profiler:
+      profiler.CountSingleton(
+          key.name, container._GetProfiledScopeName(key.name), hit=hit)
+    if hit:
+      return scope.scoped_values[key]
+    return scope.CreateScoped(key, f, *args, **kwargs)
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
+
+
+def _CreateSingleFlightInjectableWrapper(container, f, injections, key):
+  bound = _GetBoundContainer(container)
+  lazy = _GetLazyInjections(_GetProviderArgspec(f))
+
+  def Wrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if args or kwargs:
+      return f(*args, **kwargs)
+    try:
+      dep_scope = container._CalculateScopeDep(injections, lazy)
+    except ValueError:
+      return f()  # Not shared, the injection of f raises the missing name.
+    return dep_scope.CallSingleFlight(key, f)
+
+  def InstrumentedWrapper(*args, **kwargs):
+    container = bound or _DEFAULT_CONTAINER
+    if args or kwargs:
+      return f(*args, **kwargs)
+    try:
+      dep_scope = container._CalculateScopeDep(injections, lazy)
+    except ValueError:
+      return f()  # Not shared, the injection of f raises the missing name.
+    if _TRACING:
+      logging.debug('Injecting single flight %r in scope %s',
+                    key.name, dep_scope.name)
+    return dep_scope.CallSingleFlight(key, f)
+  return _Instrumentable(f, Wrapper, InstrumentedWrapper)
 
 
 class _InjectFunction(object):
@@ -284,7 +1313,8 @@ class _InjectFunction(object):
   NOT_INJECTABLE_ERR = 'Requested injectable is not callable.'
   SHORT_ARG_COUNT = 0
 
-  def __init__(self, f):
+  def __init__(self, container, f):
+    self.container = container
     self.f = f
     self.name = f.__name__
     self._argspec = None
@@ -320,10 +1350,30 @@ class _InjectFunction(object):
   def singleton(self):
     return hasattr(self.f, 'ioc_singleton')
 
+  @property
+  def singleton_policy(self):
+    return getattr(self.f, 'ioc_singleton_policy', None)
+
+  @property
+  def singleton_fingerprint(self):
+    return getattr(self.f, 'ioc_singleton_fingerprint', None)
+
+  @property
+  def singleton_refresh(self):
+    return getattr(self.f, 'ioc_singleton_refresh', None)
+
   @property
   def eager(self):
     return hasattr(self.f, 'ioc_eager')
 
+  @property
+  def scoped(self):
+    return hasattr(self.f, 'ioc_scoped')
+
+  @property
+  def single_flight(self):
+    return hasattr(self.f, 'ioc_single_flight')
+
   @property
   def callable(self):
     return self.f
@@ -336,7 +1386,8 @@ class _InjectFunction(object):
       if self.already_injected:
         self._wrapper = self.callable
       else:
-        self._wrapper = _CreateInjectWrapper(self.callable, self.injections)
+        self._wrapper = _CreateInjectWrapper(self.container, self.callable,
+                                             self.injections)
     return self._wrapper
 
   def __call__(self, *args, **kwargs):
@@ -344,20 +1395,76 @@ class _InjectFunction(object):
       self._inject = self.wrapper
     return self._inject(*args, **kwargs)
 
-  @property
-  def injectable_wrapper(self):
-    """Returns a wrapper that can be used to produce value for injection."""
+  def InjectableWrapper(self, name, key):
+    """Returns a wrapper that can be used to produce value for injection.
+
+    Args:
+      name: The name the injectable is added as.
+      key: The _ProviderKey of the values the wrapper creates.
+    Returns:
+      The wrapper.
+    """
     self.CheckInjectable()
-    if self.singleton:
-      return _CreateSingletonInjectableWrapper(self.wrapper, self.injections)
+    if self.singleton_refresh:
+      return _CreateRefreshingSingletonInjectableWrapper(
+          self.container, self.wrapper, self.injections, key,
+          self.singleton_refresh)
+    elif self.singleton_policy:
+      return _CreateManagedSingletonInjectableWrapper(
+          self.container, self.wrapper, self.injections, key,
+          self.singleton_policy)
+    elif self.singleton:
+      return _CreateSingletonInjectableWrapper(
+          self.container, self.wrapper, self.injections, key,
+          self.singleton_fingerprint)
+    elif self.scoped:
+      return _CreateScopedInjectableWrapper(self.container, self.wrapper, key)
+    elif self.single_flight:
+      return _CreateSingleFlightInjectableWrapper(
+          self.container, self.wrapper, self.injections, key)
     else:
       return self.wrapper
 
 
+def _GetContainerClass(container, cls):
+  """Returns the subclass of a class injected by another container.
+
+  The container which injects a class first replaces its __init__, every
+  other one injects a subclass of its own. Instances of the subclass are
+  instances of the class as well.
+
+  Args:
+    container: The Container injecting the class.
+    cls: The class injected by another Container.
+  Returns:
+    The subclass, created once per container.
+  """
+  subclasses = cls.__dict__.get('ioc_subclasses')
+  if subclasses is None:
+    subclasses = cls.ioc_subclasses = weakref.WeakKeyDictionary()
+  try:
+    return subclasses[container]
+  except KeyError:
+    pass
+  init = _GetOriginalCallable(cls.__dict__['__init__'])
+  subclass = type(cls)(cls.__name__, (cls,), {
+      '__init__': getattr(init, 'im_func', init),
+      '__module__': cls.__module__,
+      '__doc__': cls.__doc__,
+  })
+  return subclasses.setdefault(container, subclass)
+
+
 class _InjectClass(_InjectFunction):
   ARGSPEC_ERR = 'Classes without an __init__ cannot be injected.'
   SHORT_ARG_COUNT = 1
 
+  def __init__(self, container, f):
+    if 'ioc_container' in f.__dict__ and (
+        f.__dict__['ioc_container'] is not _GetBoundContainer(container)):
+      f = _GetContainerClass(container, f)
+    super(_InjectClass, self).__init__(container, f)
+
   @property
   def callable(self):
     return self.f.__init__
@@ -365,13 +1472,16 @@ class _InjectClass(_InjectFunction):
   @property
   def wrapper(self):
     self.f.__init__ = super(_InjectClass, self).wrapper
+    if 'ioc_container' not in self.f.__dict__:
+      self.f.ioc_container = _GetBoundContainer(self.container)
     return self.f
 
 
-def _Inject(f):
+def _Inject(container, f):
   """Function wrapper that will examine the kwargs and wrap when necessary.
 
   Args:
+    container: The Container to inject from.
     f: Function to inject into.
 
   Returns:
@@ -380,148 +1490,1392 @@ def _Inject(f):
   Raises:
     ValueError: If the argument is not a callable or is already injected.
   """
-  inject = _InjectClass(f) if inspect.isclass(f) else _InjectFunction(f)
+  if inspect.isclass(f):
+    inject = _InjectClass(container, f)
+  else:
+    inject = _InjectFunction(container, f)
   logging.debug('Set up %r for injection', inject.name)
   return inject
 
 
-def Inject(f):
-  return _Inject(f).wrapper
+class _InjectableDecorator(object):
+  """Decorates a callable and creates an injectable in the current Scope.
+
+  Also creates named injectables and injectable values, see the methods.
+  """
 
+  def __init__(self, container):
+    self._container = container
 
-def Scope(f):
-  """Decorates a callable and creates a new injection Scope level."""
-  @functools.wraps(f)
-  def Wrapper(*args, **kwargs):
-    with _Scope(f):
-      return f(*args, **kwargs)
-  return Wrapper
+  def __call__(self, f):
+    self._container._CheckAlreadyInjected(f.__name__)
+    return self._container._CurrentScope().Injectable(f)
+
+  def named(self, name):  # pylint: disable=invalid-name
+    """Decorates a callable and creates a named injectable in the current Scope.
+
+    Args:
+      name: The name of the object to setup for injection.
+    Returns:
+      A decorator for an Injectable.
+    """
+
+    def Decorator(f):
+      self._container._CheckAlreadyInjected(name)
+      return self._container._CurrentScope().Injectable(f, name=name)
+    return Decorator
+
+  def value(self, **kwargs):  # pylint: disable=invalid-name
+    """Creates a named injectable value.
+
+    Example:
+      ioc.Injectable.value(bar=42)
+
+    Args:
+      **kwargs: A 1-length dict that has the name of the injectable as the key
+        and the injectable value as the value.
+    """
+    assert len(kwargs) == 1, (
+        'You can only create one injectable value at a time.')
+    self._container._CurrentScope().InjectableValues(kwargs)
+
+  def values(self, values):  # pylint: disable=invalid-name
+    """Creates named injectable values at once.
+
+    This is much cheaper than creating them one by one.
+
+    Example:
+      ioc.Injectable.values(config)
+
+    Args:
+      values: A dict of the injectable names to their values.
+    """
+    self._container._CurrentScope().InjectableValues(values)
+
+  def update(self, **kwargs):  # pylint: disable=invalid-name
+    """Creates named injectable values at once, see Injectable.values.
+
+    Example:
+      ioc.Injectable.update(bar=42, baz=7)
+
+    Args:
+      **kwargs: The names of the injectables and their values.
+    """
+    self._container._CurrentScope().InjectableValues(kwargs)
+
+
+class SingletonPolicy(object):
+  """Limits how long singletons are kept in the scope they attach to.
+
+  Singletons without a policy are kept for the life of their scope. With a
+  policy, they are evicted once expired or once the scope holds too many of
+  them, and created anew when injected again. The policy may be shared by
+  several singletons to bound them together.
+
+  Example:
+    connections = ioc.SingletonPolicy(max_size=10, dispose=Connection.close)
+
+    @ioc.Injectable.named('users_db')
+    @ioc.Singleton(policy=connections)
+    def UsersConnection():
+      return Connection('users')
+  """
+
+  def __init__(self, max_size=None, ttl=None, dispose=None):
+    """Creates a singleton policy.
+
+    Args:
+      max_size: The most singletons of the policy a scope keeps. The least
+        recently injected one is evicted first.
+      ttl: The seconds after which a singleton is evicted.
+      dispose: A callable called with each singleton evicted or released
+        along with its scope, e.g. to close it.
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self.dispose = dispose
 
 
-def _CheckAlreadyInjected(name):
-  """Checks if an injectable name is already in use in current scope."""
-  curr_scope = _CurrentScope()
-  if name in curr_scope:
-    raise ValueError('Injectable %r already exist in scope %r.' %
-                     (name, curr_scope.name))
+def Singleton(f=None, dispose=None, ttl=None, policy=None, fingerprint=None):
+  """Decorates a callable and sets it as a singleton.
 
+  Must be used in conjunction with a call to Injectable. Can be used with
+  arguments to give the singleton a SingletonPolicy, or a fingerprint to save
+  it with SaveWarmState.
 
-def Injectable(f):
-  """Decorates a callable and creates an injectable in the current Scope."""
-  _CheckAlreadyInjected(f.__name__)
-  return _CurrentScope().Injectable(f)
+  Example:
+    @ioc.Injectable
+    @ioc.Singleton(dispose=lambda f: f.close())
+    def log_file():
+      return open('log.txt', 'a')
 
+  Args:
+    f: A callable to mark as an injectable singleton.
+    dispose: A callable called with the singleton once it is released along
+      with its scope.
+    ttl: The seconds after which the singleton is created anew.
+    policy: A SingletonPolicy, instead of dispose and ttl.
+    fingerprint: The version of the singleton, or a callable returning it,
+      e.g. the modification time of the file it is built from. Singletons are
+      only restored by Warmup from a snapshot with the same fingerprint.
+  Returns:
+    The callable set to be a singleton when injected, or a decorator setting
+    it if f is None.
+  """
+  if dispose is not None or ttl is not None:
+    assert policy is None, 'Either give a policy or dispose and ttl.'
+    policy = SingletonPolicy(ttl=ttl, dispose=dispose)
+  assert policy is None or fingerprint is None, (
+      'Singletons with a SingletonPolicy cannot be saved.')
 
-def _InjectableNamed(name):
-  """Decorates a callable and creates a named injectable in the current Scope.
+  def Decorator(f):
+    f.ioc_singleton = True
+    if policy:
+      f.ioc_singleton_policy = policy
+    if fingerprint is not None:
+      f.ioc_singleton_fingerprint = fingerprint
+    return f
+  return Decorator if f is None else Decorator(f)
+
+
+def _EagerSingleton(f=None, fingerprint=None):
+  """Decorates a callable and sets it as an eager singleton.
+
+  Must be used in conjunction with a call to Injectable. Can be used with a
+  fingerprint argument, see Singleton.
 
   Args:
-    name: The name of the object to setup for injection.
+    f: A callable to mark as an injectable eager singleton.
+    fingerprint: The version of the singleton, or a callable returning it.
   Returns:
-    A decorator for an Injectable.
+    The callable set to be a eager singleton when injected, or a decorator
+    setting it if f is None.
   """
 
   def Decorator(f):
-    _CheckAlreadyInjected(name)
-    return _CurrentScope().Injectable(f, name=name)
-  return Decorator
-Injectable.named = _InjectableNamed
+    f.ioc_eager = True
+    return Singleton(f, fingerprint=fingerprint)
+  return Decorator if f is None else Decorator(f)
+Singleton.eager = _EagerSingleton
 
 
-def _InjectableValue(**kwargs):
-  """Creates a named injectable value.
+_SingletonRefresh = collections.namedtuple('_SingletonRefresh',
+                                           ['interval', 'stale_ok'])
+
+
+def _RefreshingSingleton(interval, stale_ok=None):
+  """Decorates a callable and sets it as a singleton refreshed on a thread.
+
+  Once the singleton is older than interval, the next injection starts
+  creating it anew on a thread and still gets the current singleton. The new
+  singleton replaces it once created. Only the first injection waits for the
+  singleton to be created, unless it gets too stale.
+
+  Must be used in conjunction with a call to Injectable.
 
   Example:
-    ioc.Injectable.value(bar=42)
+    @ioc.Injectable
+    @ioc.Singleton.refreshing(interval=60, stale_ok=600)
+    def feature_flags(flags_client=ioc.IN):
+      return flags_client.Snapshot()
 
   Args:
-    **kwargs: A 1-length dict that has the name of the injectable as the key and
-      the injectable value as the value.
+    interval: The seconds after which the singleton is refreshed.
+    stale_ok: The seconds past interval during which the current singleton is
+      still injected, e.g. while refreshing it fails. Injections wait for the
+      singleton to be created anew afterwards. None to always inject the
+      current singleton.
+  Returns:
+    A decorator setting the callable to be a refreshing singleton.
   """
-  assert len(kwargs) == 1, 'You can only create one injectable value at a time.'
-  name, ioc_value = kwargs.popitem()
-  Injectable(_CreateCallable(name, ioc_value))
-Injectable.value = _InjectableValue
+
+  def Decorator(f):
+    assert not hasattr(f, 'ioc_singleton_policy'), (
+        'Refreshing singletons cannot have a SingletonPolicy.')
+    f.ioc_singleton_refresh = _SingletonRefresh(interval, stale_ok)
+    return Singleton(f)
+  return Decorator
+Singleton.refreshing = _RefreshingSingleton
 
 
-def Singleton(f):
-  """Decorates a callable and sets it as a singleton.
+def Scoped(f):
+  """Decorates a callable and sets it as scoped.
+
+  A scoped injectable is created once per scope it is injected in, and
+  released when that scope is left. The scope is the innermost one at the time
+  of the injection, which makes a scoped injectable a cache per request.
 
   Must be used in conjunction with a call to Injectable.
 
   Args:
-    f: A callable to mark as an injectable singleton.
+    f: A callable to mark as a scoped injectable.
   Returns:
-    The callable set to be a singleton when injected.
+    The callable set to be scoped when injected.
   """
-  f.ioc_singleton = True
+  f.ioc_scoped = True
   return f
 
 
-def _EagerSingleton(f):
-  """Decorates a callable and sets it as an eager singleton.
+def SingleFlight(f):
+  """Decorates a callable and sets it as single flight.
+
+  Concurrent injections of a single flight injectable share one call of it
+  instead of calling it each. Injections after the call returned call it
+  again. Only injections resolving its dependencies from the same scope share
+  a call, and calls given arguments are never shared.
 
   Must be used in conjunction with a call to Injectable.
 
+  Example:
+    @ioc.Injectable
+    @ioc.SingleFlight
+    def routes(routes_path=ioc.IN):
+      return ParseRoutes(routes_path)
+
   Args:
-    f: A callable to mark as an injectable eager singleton.
+    f: A callable to mark as a single flight injectable.
   Returns:
-    The callable set to be a eager singleton when injected.
+    The callable set to be single flight when injected.
   """
-  f.ioc_eager = True
-  return Singleton(f)
-Singleton.eager = _EagerSingleton
+  f.ioc_single_flight = True
+  return f
+
 
+def _TimeWarmup(name, eager):
+  """Instantiates an eager singleton and returns the seconds it took."""
+  start = time.time()
+  eager()
+  elapsed = time.time() - start
+  logging.debug('Eager singleton %r took %.3fs', name, elapsed)
+  return elapsed
 
-def Warmup():
-  """Instantiates all the eager singleton injectables."""
-  logging.debug('Warming up ALL')
-  for scope in _MyScopes():
-    scope.Warmup()
-  logging.debug('Hot ALL')
 
+def _GetProviderIdentity(name, provider):
+  """Returns what identifies an injectable in a warm state snapshot."""
+  original = _GetOriginalCallable(provider)
+  return (name, getattr(original, '__module__', None),
+          getattr(original, '__name__', None))
 
-def DumpInjectionStack():
-  for scope in _MyScopes():
-    print scope
 
+def _GetFingerprint(provider):
+  fingerprint = provider.ioc_singleton_fingerprint
+  return fingerprint() if callable(fingerprint) else fingerprint
 
-def SetTestMode(enabled=True):
-  """Enters or leaves the test mode.
 
-  Test mode means the following:
-    - Injections are _prohibited_ and will cause an AssertionError to be raised.
-    - Classes may have their injectable values set.
-      ioc.SetClassInjections(InjectedCls, injected_arg=42)
-      This functionality should be used for super classes.
+def _WarmupInParallel(container, eagers, parallel):
+  """Instantiates eager singletons on threads in their dependency order.
+
+  An eager singleton is only started once all of the eager singletons it
+  transitively depends on are instantiated.
 
   Args:
-    enabled: True to enable the test mode, false to disable it.
+    container: The Container of the eager singletons.
+    eagers: A list of (name, eager singleton injectable) pairs.
+    parallel: The number of threads to use.
+  Returns:
+    A dict of the seconds it took to instantiate each eager singleton.
+  Raises:
+    ValueError: If the eager singletons depend on each other in a cycle.
   """
-  global _IN_TEST_MODE
-  _IN_TEST_MODE = enabled
-
+  eager_map = dict(eagers)
+  waiting_on = {}
+  dependents = collections.defaultdict(list)
+  for name, eager in eagers:
+    deps = container._GetTransitiveInjections(_GetProviderInjections(eager))
+    deps = set(deps & set(eager_map)) - set([name])
+    waiting_on[name] = deps
+    for dep in deps:
+      dependents[dep].append(name)
+
+  scopes = container._MyScopes()[:]
+  ready = Queue.Queue()
+  done = Queue.Queue()
+
+  def Work():
+    container._data.scopes = scopes[:]
+    while True:
+      name = ready.get()
+      if name is None:
+        return
+      try:
+        done.put((name, _TimeWarmup(name, eager_map[name]), None))
+      except Exception:  # pylint: disable=broad-except
+        done.put((name, None, sys.exc_info()))
+
+  workers = [threading.Thread(target=Work) for _ in range(parallel)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+
+  timings = {}
+  try:
+    running = 0
+    for name, _ in eagers:
+      if not waiting_on[name]:
+        ready.put(name)
+        running += 1
+    while running:
+      name, elapsed, error = done.get()
+      running -= 1
+      if error:
+        raise error[0], error[1], error[2]
+      timings[name] = elapsed
+      for dependent in dependents[name]:
+        waiting_on[dependent].discard(name)
+        if not waiting_on[dependent]:
+          ready.put(dependent)
+          running += 1
+  finally:
+    for worker in workers:
+      ready.put(None)
+    for worker in workers:
+      worker.join()
+
+  if len(timings) < len(eager_map):
+    raise ValueError('Eager singletons %r depend on each other in a cycle.' %
+                     sorted(set(eager_map) - set(timings)))
+  return timings
+
+
+InjectionGraph = collections.namedtuple('InjectionGraph',
+                                        ['order', 'dependencies',
+                                         'dep_scopes'])
+
+
+def _FindCycle(name, dependencies):
+  """Returns a cycle reached from name, where every name depends on another."""
+  path = [name]
+  while path.count(path[-1]) == 1:
+    path.append(dependencies[path[-1]][0])
+  return path[path.index(path[-1]):]
+
+
+def _CheckInjectionGraph(injection_scope_map, provided=()):
+  """Checks the injectables of an injection scope map.
+
+  LAZY injections are required to exist, but do not form cycles since they
+  are only resolved when used.
 
-def SetUpTestInjections(**kwargs):
-  """Sets up injectable values for testing.
+  Args:
+    injection_scope_map: The injection scope map entries to check.
+    provided: The names of injectables which scopes provide later, which are
+      not required to exist.
+  Returns:
+    A pair of the injectable names ordered after the names they depend on and
+    a list of messages describing the problems found.
+  """
+  errors = []
+  waiting_on = {}
+  dependents = collections.defaultdict(list)
+  for name in sorted(injection_scope_map):
+    provider = injection_scope_map[name].callable
+    injections = _GetProviderInjections(provider)
+    if injections:
+      lazy = _GetLazyInjections(_GetProviderArgspec(provider))
+    waiting_on[name] = set()
+    for injection in injections:
+      if injection not in injection_scope_map:
+        if injection not in provided:
+          errors.append('Injectable %r requires %r, which was not found.' %
+                        (name, injection))
+      elif injection not in lazy:
+        waiting_on[name].add(injection)
+        dependents[injection].append(name)
+
+  order = []
+  ready = collections.deque(name for name in sorted(waiting_on)
+                            if not waiting_on[name])
+  while ready:
+    name = ready.popleft()
+    order.append(name)
+    for dependent in dependents[name]:
+      waiting_on[dependent].discard(name)
+      if not waiting_on[dependent]:
+        ready.append(dependent)
+
+  # What is left depends on itself through a cycle.
+  cyclic = dict((name, sorted(deps)) for name, deps in waiting_on.iteritems()
+                if deps)
+  reported = set()
+  for name in sorted(cyclic):
+    cycle = _FindCycle(name, cyclic)
+    if frozenset(cycle) not in reported:
+      reported.add(frozenset(cycle))
+      errors.append('Injectables depend on each other in a cycle: %s.' %
+                    ' -> '.join(repr(injection) for injection in cycle))
+  return order, errors
+
+
+def SetTracing(enabled=True):
+  """Enables or disables debug logging of every injection.
+
+  Injection wrappers contain no logging calls unless tracing or profiling is
+  enabled. The wrappers created so far are swapped for their instrumented
+  versions and back.
 
   Args:
-    **kwargs: name and values for the injectables to be created.
+    enabled: True to enable the tracing, false to disable it.
+  """
+  global _TRACING
+  _TRACING = enabled
+  _SwapInstrumentation()
+
+
+class _Profiler(object):
+  """Collects the statistics of the injections while profiling."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.providers = collections.defaultdict(
+        lambda: {'calls': 0, 'inclusive': 0.0, 'exclusive': 0.0,
+                 'singleton_hits': 0, 'singleton_misses': 0})
+    self.stacks = collections.defaultdict(float)
+    self.scope_map_rebuilds = 0
+
+  def Enter(self, name, scope_name):
+    """Starts timing a provider call on the current thread."""
+    frames = self._local.__dict__.setdefault('frames', [])
+    # A frame is [key, start time, time spent in nested provider calls].
+    frames.append([(name, scope_name), time.time(), 0.0])
+
+  def Exit(self):
+    """Stops timing the latest provider call on the current thread."""
+    frames = self._local.frames
+    key, start, nested = frames[-1]
+    inclusive = time.time() - start
+    stack = ';'.join('%s@%s' % frame[0] for frame in frames)
+    frames.pop()
+    if frames:
+      frames[-1][2] += inclusive
+    with self._lock:
+      stats = self.providers[key]
+      stats['calls'] += 1
+      stats['inclusive'] += inclusive
+      stats['exclusive'] += inclusive - nested
+      self.stacks[stack] += inclusive - nested
+
+  def CountSingleton(self, name, scope_name, hit):
+    with self._lock:
+      stats = self.providers[(name, scope_name)]
+      stats['singleton_hits' if hit else 'singleton_misses'] += 1
+
+  def CountScopeMapRebuild(self):
+    with self._lock:
+      self.scope_map_rebuilds += 1
+
+
+def StartProfiling():
+  """Starts profiling the injections, discarding any earlier profile.
+
+  Injection wrappers are swapped for instrumented versions while profiling,
+  so there is no profiling overhead otherwise.
   """
-  global _TEST_SCOPE
-  _TEST_SCOPE = _TEST_SCOPE or _Scope(None)
-  for name, value in kwargs.iteritems():
-    _TEST_SCOPE.Injectable(_CreateCallable(name, value))
+  global _PROFILER
+  _PROFILER = _Profiler()
+  _SwapInstrumentation()
 
 
-def _CreateCallable(name, value):
-  def Callable():
-    return value
-  Callable.__name__ = name
-  return Callable
+def StopProfiling():
+  """Stops profiling the injections, keeping the profile for GetProfile."""
+  global _PROFILER, _LAST_PROFILER
+  _LAST_PROFILER, _PROFILER = _PROFILER or _LAST_PROFILER, None
+  _SwapInstrumentation()
+
+
+def GetProfile():
+  """Returns the statistics of the current or last profile.
+
+  Returns:
+    A dict with the number of scope_map_rebuilds and the providers: a dict
+    of scope names to dicts of injection names to their statistics. These are
+    the calls with their inclusive and exclusive seconds, and the
+    singleton_hits and singleton_misses of singletons and scoped injectables.
+  """
+  profiler = _PROFILER or _LAST_PROFILER
+  profile = {'providers': {}, 'scope_map_rebuilds': 0}
+  if profiler:
+    with profiler._lock:  # pylint: disable=protected-access
+      for (name, scope_name), stats in profiler.providers.iteritems():
+        profile['providers'].setdefault(scope_name, {})[name] = dict(stats)
+      profile['scope_map_rebuilds'] = profiler.scope_map_rebuilds
+  return profile
+
+
+def GetCollapsedProfile():
+  """Returns the profile in the collapsed stack format of flame graphs.
+
+  Returns:
+    A string with a line per stack of nested provider calls. Frames are
+    written as name@scope and separated by semicolons, followed by the
+    exclusive microseconds spent in the stack.
+  """
+  profiler = _PROFILER or _LAST_PROFILER
+  if not profiler:
+    return ''
+  with profiler._lock:  # pylint: disable=protected-access
+    stacks = sorted(profiler.stacks.iteritems())
+  return ''.join('%s %d\n' % (stack, round(seconds * 1e6))
+                 for stack, seconds in stacks)
+
+
+_CapturedScopes = collections.namedtuple('_CapturedScopes',
+                                         ['scopes', 'injection_scope_map'])
+
 
+class ScopedExecutor(object):
+  """A thread pool executor running its tasks in the submitting scope.
 
-def TearDownTestInjections():
-  """Tears down any injections set up for testing."""
-  global _TEST_SCOPE
-  _TEST_SCOPE = None
+  Wraps a concurrent.futures.ThreadPoolExecutor, which on Python 2 is provided
+  by the futures package. The scopes are those of the default container unless
+  another Container is given as the container keyword argument.
+
+  Example:
+    @ioc.Scope
+    def HandleRequest(executor, urls):
+      ioc.Injectable.value(session=CreateSession())
+      return list(executor.map(Fetch, urls))  # Fetch may inject session.
+  """
+
+  def __init__(self, *args, **kwargs):
+    if futures is None:
+      raise ImportError('ScopedExecutor requires concurrent.futures, install '
+                        'the futures package.')
+    self._container = kwargs.pop('container', None) or _DEFAULT_CONTAINER
+    self._executor = futures.ThreadPoolExecutor(*args, **kwargs)
+
+  def submit(self, fn, *args, **kwargs):  # pylint: disable=invalid-name
+    # The arguments are bound first, so that they may have any name.
+    return self._executor.submit(self._container.RunIn,
+                                 self._container.Capture(),
+                                 functools.partial(fn, *args, **kwargs))
+
+  def map(self, fn, *iterables, **kwargs):  # pylint: disable=invalid-name
+    return self._executor.map(
+        functools.partial(self._container.RunIn, self._container.Capture(),
+                          fn), *iterables, **kwargs)
+
+  def shutdown(self, wait=True):  # pylint: disable=invalid-name
+    self._executor.shutdown(wait)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, tb):
+    self.shutdown(wait=True)
+
+
+def _GetOriginalCallable(provider):
+  while hasattr(provider, 'ioc_wrapper'):
+    provider = provider.ioc_wrapper
+  return provider
+
+
+class Container(object):
+  """An injection graph with its own scopes, singletons and caches.
+
+  The module level functions, such as ioc.Inject and ioc.Injectable, use the
+  default container. Other containers share nothing with it or with each
+  other, not even locks, e.g. to serve several tenants or plugins from one
+  process without their injectables clashing.
+
+  Example:
+    tenant = ioc.Container()
+
+    @tenant.Injectable
+    def user():
+      return 'Anonymous'
+
+    @tenant.Inject
+    def Hello(user=ioc.IN):
+      return 'Hello %s' % user
+
+  Callables are injected from the container which decorated them, the
+  injections of the default container are not visible to them. A class
+  injected by several containers is only changed by the first one, the
+  others inject a subclass of it.
+  """
+
+  def __init__(self):
+    self.in_test_mode = False
+    self.test_scope = None
+    self.root = _Scope(self, None)  # Create Root scope
+    self.Injectable = _InjectableDecorator(self)  # pylint: disable=invalid-name
+    self._base_scopes = [self.root]
+    self._data = threading.local()
+    self._generation = 0
+    self._generation_lock = threading.Lock()
+    self._frozen_injections = None
+    self._provider_keys = weakref.WeakKeyDictionary()
+    _CONTAINERS[self] = None
+
+  def _MyScopes(self):
+    if not hasattr(self._data, 'scopes'):
+      # The scope stack of the main thread is the base scopes, whichever
+      # thread created the container.
+      if threading.currentThread().ident == _MAIN_THREAD_ID:
+        self._data.scopes = self._base_scopes
+      else:
+        self._data.scopes = self._base_scopes[:]
+    return self._data.scopes
+
+  def _CurrentScope(self):
+    return self._MyScopes()[-1]
+
+  def _EnterScope(self, scope):
+    if os.getpid() != _PID:
+      _CheckFork()
+    self._MyScopes().append(scope)
+    scope_map = getattr(self._data, 'injection_scope_map', None)
+    if scope_map is not None:
+      scope_map.Push()
+      names = tuple(scope)
+      if names:  # When resuming a generator scope.
+        scope_map.Add(scope, *names)
+
+  def _ExitScope(self, unused_scope):
+    self._MyScopes().pop()
+    scope_map = getattr(self._data, 'injection_scope_map', None)
+    if scope_map is not None:
+      scope_map.Pop()
+
+  def _ResetInjectionScopeMap(self):
+    """Delete the injection_scope_map to force the recalculate.
+
+    The injection plans and dependencies computed from the map are dropped
+    along with it.
+    """
+    if hasattr(self._data, 'injection_scope_map'):
+      del self._data.injection_scope_map
+
+  def _NewGeneration(self, scope_map=None):
+    """Invalidates the injection scope maps of all threads.
+
+    Used whenever a scope shared between threads changes.
+
+    Args:
+      scope_map: The injection scope map of the current thread, which stays
+        valid if it was up to date and gets updated by the caller.
+    """
+    with self._generation_lock:
+      up_to_date = scope_map is not None and (
+          scope_map.generation == self._generation)
+      self._generation += 1
+      if up_to_date:
+        scope_map.generation = self._generation
+
+  def _GetInjectionScopeMap(self):
+    scope_map = getattr(self._data, 'injection_scope_map', None)
+    if scope_map is None or scope_map.generation != self._generation:
+      if os.getpid() != _PID:
+        _CheckFork()
+      scope_map = self._data.injection_scope_map = _InjectionScopeMap(
+          self._MyScopes(), self._generation, self._frozen_injections)
+      if _PROFILER:
+        _PROFILER.CountScopeMapRebuild()
+    return scope_map
+
+  def _AddToInjectionScopeMap(self, scope, *names):
+    """Updates the injection_scope_map for injectables added to a scope."""
+    scope_map = getattr(self._data, 'injection_scope_map', None)
+    if scope.shared:
+      self._NewGeneration(scope_map)
+    if scope_map is None:
+      return
+    if scope is self._CurrentScope():
+      scope_map.Add(scope, *names)
+    else:
+      self._ResetInjectionScopeMap()
+
+  def _GetCurrentInjectionInfo(self):
+    """Returns a mapping contains the required injections' information.
+
+    This method is used to provide information for filling injection and
+    calculating scope dependency.
+    """
+    return self._GetInjectionScopeMap()
+
+  def _CompileInjectionPlan(self, injection_scope_map, injections):
+    """Resolves the providers of the injections in the current scope stack.
+
+    Args:
+      injection_scope_map: The injection scope map of the current thread.
+      injections: A tuple of the injection names to resolve.
+    Returns:
+      A tuple of (name, provider) pairs. Names which cannot be resolved get a
+      provider raising the error the injection would have raised.
+    """
+    if self.in_test_mode:
+      if self.test_scope is None:
+        not_setup = _CreateRaiser(TestInjectionsNotSetupError,
+                                  'Test injections have not been setup.')
+        return tuple((injection, not_setup) for injection in injections)
+      providers = self.test_scope
+    else:
+      providers = dict((name, injection_scope_map[name].callable)
+                       for name in injections if name in injection_scope_map)
+
+    plan = []
+    for injection in injections:
+      if injection in providers:
+        provider = providers[injection]
+        if isinstance(provider, _ConstantProvider):
+          # Returns the value without running any Python code.
+          provider = itertools.repeat(provider.value).next
+      else:
+        provider = _CreateRaiser(
+            InjectionMissingError,
+            'The injectable named %r was not found.' % injection)
+      plan.append((injection, provider))
+    return tuple(plan)
+
+  def _GetInjectionPlan(self, key, injections):
+    """Returns the cached injection plan of a callable, compiling it if needed.
+
+    Plans are cached in the injection scope map of the thread and dropped
+    whenever the map changes.
+
+    Args:
+      key: The injected callable the plan is cached for.
+      injections: A tuple of the injection names of the callable.
+    Returns:
+      A tuple of (name, provider) pairs.
+    """
+    scope_map = self._GetInjectionScopeMap()
+    try:
+      return scope_map.plans[key]
+    except KeyError:
+      plan = scope_map.plans[key] = self._CompileInjectionPlan(
+          scope_map, injections)
+      return plan
+
+  def _ResolveInjectionPlan(self, key, injections):
+    """Returns the injection plan of a callable for the current thread."""
+    # The plan is usually cached in an up to date map, see _GetInjectionPlan.
+    scope_map = getattr(self._data, 'injection_scope_map', None)
+    if scope_map is not None and scope_map.generation == self._generation:
+      plan = scope_map.plans.get(key)
+      if plan is not None:
+        return plan
+    return self._GetInjectionPlan(key, injections)
+
+  def _FillInInjections(self, key, injections, arguments, lazy=frozenset(),
+                        call=None):
+    for injection, provider in self._ResolveInjectionPlan(key, injections):
+      if injection not in arguments:
+        if call:
+          provider = functools.partial(call, injection, provider)
+        if injection in lazy:
+          arguments[injection] = _LazyProxy(provider)
+        else:
+          arguments[injection] = provider()
+
+  def _CalculateScopeDep(self, injections, lazy=frozenset()):
+    """Returns the deepest required scope inside the current scope tree.
+
+    Names which are only injected lazily may be missing, they are left out.
+    The result is cached in the injection scope map of the thread, unless
+    such names are missing.
+
+    Args:
+      injections: A tuple of injection names.
+      lazy: The names of the injections which are injected lazily.
+    Returns:
+      The scope.
+    Raises:
+      ValueError: If a name which is not only injected lazily is missing.
+    """
+    scope_map = self._GetInjectionScopeMap()
+    try:
+      return scope_map.dep_scopes[injections]
+    except KeyError:
+      pass
+    dep_scope_idx, dep_scope = 0, self._MyScopes()[0]  # root scope.
+
+    missing = []
+    for injection in self._GetTransitiveInjections(injections):
+      if injection not in scope_map:
+        missing.append(injection)
+        continue
+      idx, scope, _ = scope_map[injection]
+      if idx > dep_scope_idx:
+        dep_scope_idx, dep_scope = idx, scope
+
+    if missing:
+      required = _GetRequiredInjections(scope_map, injections, lazy)
+      for injection in missing:
+        if injection in required:
+          raise ValueError('The injectable named %r was not found.' %
+                           injection)
+    else:
+      scope_map.dep_scopes[injections] = dep_scope
+    return dep_scope
+
+  def _GetTransitiveInjections(self, injections):
+    """Returns the names the injections depend on in the current scope tree.
+
+    Every name is expanded once, names without a provider are included but
+    not followed. The result is cached in the injection scope map of the
+    thread, so scopes which do not provide any of the names, such as those of
+    most requests, keep it.
+
+    Args:
+      injections: A tuple of injection names.
+    Returns:
+      A frozenset of the injection names and all the names they depend on.
+    """
+    scope_map = self._GetInjectionScopeMap()
+    try:
+      return scope_map.dependencies[injections]
+    except KeyError:
+      pass
+    seen = set()
+    injection_queue = collections.deque(injections)
+    while injection_queue:
+      injection = injection_queue.popleft()
+      if injection in seen:
+        continue
+      seen.add(injection)
+      if injection in scope_map:
+        injection_queue.extend(
+            _GetProviderInjections(scope_map[injection].callable))
+    dependencies = frozenset(seen)
+    scope_map.AddDependencies(injections, dependencies)
+    return dependencies
+
+  def _CallProvider(self, name, provider):
+    """Calls the provider of an injection, profiling it when enabled."""
+    profiler = _PROFILER
+    if profiler is None:
+      return provider()
+    profiler.Enter(name, self._GetProfiledScopeName(name))
+    try:
+      return provider()
+    finally:
+      profiler.Exit()
+
+  def _GetProfiledScopeName(self, name):
+    """Returns the name of the scope providing an injection for the profile.
+
+    Singletons are counted under the scope providing them as well, rather
+    than the scope they attach to.
+    """
+    if self.in_test_mode:
+      scope = self.test_scope
+    else:
+      entry = self._GetCurrentInjectionInfo().get(name)
+      scope = entry and entry.scope
+    return scope.name if scope else None
+
+  def _FindSingletonScope(self, key):
+    """Returns the outermost scope of the current stack holding a singleton.
+
+    The scope is cached in the injection scope map of the thread.
+
+    Args:
+      key: The _ProviderKey of the singleton.
+    Returns:
+      The scope or None if the singleton was not created in the scope stack.
+    """
+    scope_map = self._GetInjectionScopeMap()
+    scope = scope_map.singleton_scopes.get(key)
+    if scope is not None and key in scope.singletons:
+      return scope
+    for idx, scope in enumerate(self._MyScopes()):
+      if key in scope.singletons:
+        scope_map.AddSingletonScope(key, idx, scope)
+        return scope
+    return None
+
+  def _GetProvider(self, name, entry):
+    """Returns the provider of an entry of the injection scope map.
+
+    Unlike the callable of the entry, it is never a value the provider
+    returned, see Freeze.
+    """
+    return entry.scope[name]
+
+  def _CheckAlreadyInjected(self, name):
+    """Checks if an injectable name is already in use in current scope."""
+    curr_scope = self._CurrentScope()
+    if name in curr_scope:
+      raise ValueError('Injectable %r already exist in scope %r.' %
+                       (name, curr_scope.name))
+
+  def Inject(self, f):
+    """Decorates a callable to inject its IN and LAZY arguments."""
+    return _Inject(self, f).wrapper
+
+  def Scope(self, f):
+    """Decorates a callable and creates a new injection Scope level.
+
+    Generator functions, such as the coroutines of Tornado or Twisted, get a
+    scope which is only entered while the generator runs. Generators which
+    interleave on one thread therefore never see each other's injectables.
+
+    The scope is not propagated to the coroutines the generator starts. Once
+    the event loop resumes those, e.g. after their first yield, they are out of
+    the scope, so they should be given their injections before yielding or as
+    arguments.
+    """
+    if inspect.isgeneratorfunction(f):
+      return self._GeneratorScope(f)
+    bound = _GetBoundContainer(self)
+
+    @functools.wraps(f)
+    def Wrapper(*args, **kwargs):
+      with _Scope(bound or _DEFAULT_CONTAINER, f):
+        return f(*args, **kwargs)
+    return Wrapper
+
+  def _GeneratorScope(self, f):
+    """Decorates a generator function with a scope entered on every resume.
+
+    Only the frame of the generator runs in the scope, not the generators or
+    futures it yields to the event loop.
+    """
+    bound = _GetBoundContainer(self)
+
+    @functools.wraps(f)
+    def Wrapper(*args, **kwargs):
+      scope = _Scope(bound or _DEFAULT_CONTAINER, f)
+      scope.resumable = True
+      generator = f(*args, **kwargs)
+      value, error = None, None
+      try:
+        while True:
+          with scope:
+            try:
+              if error:
+                yielded = generator.throw(*error)
+              else:
+                yielded = generator.send(value)
+            except StopIteration:
+              return
+          try:
+            value, error = (yield yielded), None
+          except GeneratorExit:
+            with scope:
+              generator.close()
+            raise
+          except Exception:  # pylint: disable=broad-except
+            value, error = None, sys.exc_info()
+      finally:
+        scope.Release()
+    return Wrapper
+
+  def Warmup(self, parallel=None, from_snapshot=None):
+    """Instantiates all the eager singleton injectables.
+
+    Args:
+      parallel: The number of threads instantiating independent eager
+        singletons of a scope at the same time, or None to instantiate them
+        one after another.
+      from_snapshot: The path of a file written by SaveWarmState to restore
+        the singletons from first. Singletons whose fingerprint changed since
+        are instantiated anew, as are all of them if the file is missing.
+    Returns:
+      A dict of the seconds it took to instantiate each eager singleton.
+    """
+    logging.debug('Warming up ALL')
+    if from_snapshot:
+      self._RestoreWarmState(from_snapshot)
+    timings = {}
+    for scope in self._MyScopes():
+      timings.update(scope.Warmup(parallel=parallel))
+    logging.debug('Hot ALL')
+    return timings
+
+  def SaveWarmState(self, path):
+    """Saves the singletons with a fingerprint for Warmup to restore them.
+
+    The singletons visible from the current scope are pickled along with
+    their fingerprint, e.g. once the eager singletons are warmed up. Those
+    which are not created yet or cannot be pickled are left out. The file is
+    replaced atomically.
+
+    Example:
+      ioc.Warmup(from_snapshot=WARM_STATE)
+      ioc.SaveWarmState(WARM_STATE)
+
+    Args:
+      path: The path of the file to write.
+    """
+    singletons = {}
+    for name, entry in self._GetCurrentInjectionInfo().iteritems():
+      provider = self._GetProvider(name, entry)
+      if not hasattr(provider, 'ioc_singleton_fingerprint'):
+        continue
+      scope = self._FindSingletonScope(provider.ioc_singleton_key)
+      if scope is None:
+        continue
+      try:
+        pickled = cPickle.dumps(scope.singletons[provider.ioc_singleton_key],
+                                cPickle.HIGHEST_PROTOCOL)
+      except Exception:  # pylint: disable=broad-except
+        logging.warning('Singleton %r cannot be pickled, not saving it.', name)
+        continue
+      singletons[_GetProviderIdentity(name, provider)] = (
+          _GetFingerprint(provider), pickled)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+      cPickle.dump(singletons, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+    logging.debug('Saved %d singletons to %r', len(singletons), path)
+
+  def _RestoreWarmState(self, path):
+    """Restores the singletons saved by SaveWarmState, unless they changed.
+
+    A singleton also counts as changed when a singleton it depends on is
+    not restored, since it would hold on to the previous version of it.
+    """
+    try:
+      with open(path, 'rb') as f:
+        singletons = cPickle.load(f)
+    except IOError:
+      logging.info('No warm state at %r, warming up from scratch.', path)
+      return
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Warm state at %r is corrupt, ignoring it.', path)
+      return
+    injection_scope_map = self._GetCurrentInjectionInfo()
+    order, _ = _CheckInjectionGraph(injection_scope_map)
+    restored = set()
+    for name in order:  # Dependencies first.
+      provider = injection_scope_map[name].callable
+      if not hasattr(provider, 'ioc_singleton_fingerprint'):
+        continue
+      saved = singletons.get(_GetProviderIdentity(name, provider))
+      if saved is None:
+        continue
+      injections = _GetProviderInjections(provider)
+      transitive = self._GetTransitiveInjections(injections)
+      missing = [dep for dep in transitive if dep not in injection_scope_map]
+      if missing:
+        # E.g. it was saved in a scope providing them, see SaveWarmState.
+        logging.debug('Singleton %r depends on missing injectables %r, not '
+                      'restoring it.', name, sorted(missing))
+        continue
+      rebuilt = [dep for dep in transitive
+                 if dep in injection_scope_map and dep not in restored and
+                 hasattr(injection_scope_map[dep].callable,
+                         'ioc_singleton_key')]
+      if rebuilt:
+        logging.debug('Singleton %r depends on singletons %r created anew, '
+                      'not restoring it.', name, sorted(rebuilt))
+        continue
+      fingerprint, pickled = saved
+      if fingerprint != _GetFingerprint(provider):
+        logging.debug('Singleton %r changed, not restoring it.', name)
+        continue
+      try:
+        value = cPickle.loads(pickled)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Singleton %r cannot be unpickled.', name)
+        continue
+      dep_scope = self._CalculateScopeDep(
+          injections, _GetLazyInjections(_GetProviderArgspec(provider)))
+      if hasattr(provider, 'ioc_singleton_refresh'):
+        # The restored singleton counts as refreshed now.
+        dep_scope.RefreshSingleton(provider.ioc_singleton_key, None,
+                                   _ConstantProvider(value))
+      else:
+        dep_scope.CreateSingleton(provider.ioc_singleton_key,
+                                  _ConstantProvider(value))
+      restored.add(name)
+      logging.debug('Restored singleton %r to scope %r.', name, dep_scope.name)
+
+  def Validate(self, provided=()):
+    """Checks that the injectables visible from the current scope resolve.
+
+    Call it once the injectables are set up, e.g. at start up, instead of
+    finding out about missing injectables while serving requests.
+
+    Example:
+      ioc.Validate(provided=('params',))  # Added by each request scope.
+
+    Args:
+      provided: The names of the injectables which the scopes entered later
+        provide, e.g. the parameters of a request. They are not reported as
+        missing.
+    Raises:
+      InjectionGraphError: Listing every missing injection and every cycle.
+    """
+    _, errors = _CheckInjectionGraph(self._GetCurrentInjectionInfo(),
+                                     frozenset(provided))
+    if errors:
+      raise InjectionGraphError('\n'.join(errors))
+
+  def Compile(self, provided=()):
+    """Validates the injectables visible from the current scope and compiles.
+
+    Besides validating like Validate, it computes the dependencies of every
+    injectable and the scope each singleton attaches to. The injections of the
+    current thread keep using them, except those including a name which a
+    scope entered later provides. Other threads compute their own as they
+    inject.
+
+    Args:
+      provided: The names of the injectables which the scopes entered later
+        provide, see Validate.
+    Returns:
+      An InjectionGraph of the injectable names ordered after the names they
+      depend on, a dict of the names each injectable directly depends on and a
+      dict of the scope each singleton attaches to. Singletons depending on
+      provided names attach to the scopes providing them, which are left out.
+    Raises:
+      InjectionGraphError: Listing every missing injection and every cycle.
+    """
+    injection_scope_map = self._GetCurrentInjectionInfo()
+    order, errors = _CheckInjectionGraph(injection_scope_map,
+                                         frozenset(provided))
+    if errors:
+      raise InjectionGraphError('\n'.join(errors))
+    dependencies, dep_scopes = {}, {}
+    for name in order:
+      provider = injection_scope_map[name].callable
+      dependencies[name] = injections = _GetProviderInjections(provider)
+      transitive = self._GetTransitiveInjections(injections)
+      if hasattr(provider, 'ioc_singleton_key') and all(
+          injection in injection_scope_map for injection in transitive):
+        dep_scopes[name] = self._CalculateScopeDep(injections)
+    return InjectionGraph(tuple(order), dependencies, dep_scopes)
+
+  def Freeze(self):
+    """Seals the root scope once the start up is done.
+
+    No injectables may be added to the root scope afterwards. The injection
+    scope map of every thread starts from a flat table of the root
+    injectables instead of the root scope, in which the singletons already
+    created in the root scope are resolved to their values directly, unless
+    they have a SingletonPolicy or are refreshing.
+    """
+    root = self.root
+    root.frozen = True
+    frozen_injections = {}
+    for name in root:
+      provider = root[name]
+      key = getattr(provider, 'ioc_singleton_key', None)
+      if key in root.singletons and not (
+          hasattr(provider, 'ioc_singleton_policy') or
+          hasattr(provider, 'ioc_singleton_refresh')):
+        provider = _ConstantProvider(root.singletons[key])
+      frozen_injections[name] = InjectionScope(0, root, provider)
+    self._frozen_injections = frozen_injections
+    self._NewGeneration()
+    logging.debug('Froze scope %r', root.name)
+
+  def DumpInjectionStack(self):
+    for scope in self._MyScopes():
+      print scope
+
+  def Capture(self):
+    """Captures the scope stack of the current thread to run callables in.
+
+    The callables see the injectables of the scopes as they are now, even if
+    the scopes are changed or left before the callables run. The singletons
+    are not copied, they are shared with the scopes.
+
+    Returns:
+      An object to pass to RunIn.
+    """
+    return _CapturedScopes(tuple(self._MyScopes()),
+                           self._GetInjectionScopeMap().Copy())
+
+  def RunIn(self, captured, f, *args, **kwargs):
+    """Calls a callable with the scope stack captured by Capture.
+
+    The scope stack of the current thread is restored afterwards. The scopes
+    may be left by the capturing thread before the call. The callable runs in
+    a scope of its own on top of them, which keeps the injectables it adds,
+    its Scoped values and the singletons with a SingletonPolicy it creates in
+    scopes already released until it returns.
+
+    Args:
+      captured: The object returned by Capture of this container.
+      f: The callable to call.
+      *args: Positional arguments for f.
+      **kwargs: Keyword arguments for f.
+    Returns:
+      The return value of f.
+    """
+    data = self._data
+    previous_scopes = getattr(data, 'scopes', None)
+    previous_map = getattr(data, 'injection_scope_map', None)
+    data.scopes = list(captured.scopes)
+    data.injection_scope_map = captured.injection_scope_map.Copy()
+    # Runs of the same task share the keys of the providers they add.
+    task = f
+    while isinstance(task, functools.partial):
+      task = task.func
+    task = getattr(task, 'im_func', task)
+    try:
+      with _Scope(self, None, keys_of=task):
+        return f(*args, **kwargs)
+    finally:
+      if previous_scopes is None:
+        del data.scopes
+      else:
+        data.scopes = previous_scopes
+      if previous_map is None:
+        self._ResetInjectionScopeMap()
+      else:
+        data.injection_scope_map = previous_map
+
+  def ExportInjections(self):
+    """Exports the injectables visible from the current scope for a process.
+
+    Values are exported as they are, to be pickled when the export is sent to
+    the process. Other injectables are exported as the module and name to
+    import them from in the process, their singletons are created anew there.
+    Injectables which cannot be imported, such as nested functions, are left
+    out.
+
+    Example:
+      pool = multiprocessing.Pool(initializer=ioc.InstallInjections,
+                                  initargs=(ioc.ExportInjections(),))
+
+    Returns:
+      A dict to pass to InstallInjections.
+    """
+    values, recipes = {}, {}
+    for name, entry in self._GetCurrentInjectionInfo().iteritems():
+      provider = self._GetProvider(name, entry)
+      if isinstance(provider, _ConstantProvider):
+        values[name] = provider.value
+        continue
+      original = _GetOriginalCallable(provider)
+      module = sys.modules.get(getattr(original, '__module__', None))
+      imported = getattr(module, getattr(original, '__name__', ''), None)
+      if _GetOriginalCallable(imported) is original:
+        recipes[name] = (module.__name__, original.__name__)
+      else:
+        logging.warning('Injectable %r cannot be imported, not exporting it.',
+                        name)
+    return {'values': values, 'recipes': recipes}
+
+  def InstallInjections(self, injections):
+    """Installs exported injections, e.g. as the initializer of a process.
+
+    In a forked process, AfterFork is called first. The injections are added
+    to a new scope on top of the root scope, which is kept for the life of the
+    process. Imported injectables which the root scope already provides from
+    the same callable are not added again.
+
+    Args:
+      injections: A dict returned by ExportInjections.
+    """
+    _CheckFork()
+    root = self.root
+    scope = _Scope(self, None)
+    scope.__enter__()
+    for name, (module, attr) in sorted(injections['recipes'].iteritems()):
+      __import__(module)
+      target = getattr(sys.modules[module], attr)
+      if name in root and _GetOriginalCallable(
+          root[name]) is _GetOriginalCallable(target):
+        continue
+      scope.Injectable(target, name=name)
+    scope.InjectableValues(injections['values'])
+
+  def _AfterFork(self):
+    """Resets the state of the container in a forked child, see AfterFork."""
+    self._generation_lock = threading.Lock()
+    self._base_scopes[:] = self._MyScopes()
+    self._data.scopes = self._base_scopes
+    for scope in self._base_scopes:
+      scope._singleton_locks = {}  # pylint: disable=protected-access
+      scope._managed = {}  # pylint: disable=protected-access
+      scope._managed_lock = threading.Lock()  # pylint: disable=protected-access
+      scope._refreshing = set()  # pylint: disable=protected-access
+      scope._refresh_failures = {}  # pylint: disable=protected-access
+      scope._flights = {}  # pylint: disable=protected-access
+      scope.singletons.clear()
+      scope.refreshed.clear()
+      scope.scoped_values.clear()
+    if self._frozen_injections is not None:
+      self.Freeze()  # Drops the values of the parent's root singletons.
+    self._NewGeneration()
+
+  def SetTestMode(self, enabled=True):
+    """Enters or leaves the test mode.
+
+    Test mode means the following:
+      - Injections are _prohibited_ and will cause an AssertionError to be
+        raised.
+      - Classes may have their injectable values set.
+        ioc.SetClassInjections(InjectedCls, injected_arg=42)
+        This functionality should be used for super classes.
+
+    Args:
+      enabled: True to enable the test mode, false to disable it.
+    """
+    self.in_test_mode = enabled
+    self._NewGeneration()
+
+  def SetUpTestInjections(self, **kwargs):
+    """Sets up injectable values for testing.
+
+    Args:
+      **kwargs: name and values for the injectables to be created.
+    """
+    self.test_scope = self.test_scope or _Scope(self, None)
+    for name, value in kwargs.iteritems():
+      self.test_scope.Injectable(_ConstantProvider(value), name=name)
+
+  def TearDownTestInjections(self):
+    """Tears down any injections set up for testing."""
+    self.test_scope = None
+    self._NewGeneration()
+
+
+def AfterFork():
+  """Makes the injection state safe to use in a forked child process.
+
+  Only the forking thread survives a fork. Its scopes become the base scopes
+  of the child, locks which other threads may have held are replaced, and the
+  singletons are dropped since their connections, files and threads must not
+  be shared with the parent. This applies to every Container.
+
+  multiprocessing calls it in the processes it starts. After os.fork, the
+  child should call it before injecting anything. Entering a scope calls it
+  as well, but injections from scopes entered before the fork do not.
+  """
+  global _MAIN_THREAD_ID, _PID
+  _PID = os.getpid()
+  _MAIN_THREAD_ID = threading.currentThread().ident
+  for container in _CONTAINERS.keys():
+    container._AfterFork()  # pylint: disable=protected-access
+  if _PROFILER:
+    _PROFILER.__init__()
+
+
+def _CheckFork():
+  """Calls AfterFork in a forked child process unless it was called already."""
+  if os.getpid() != _PID:
+    with _FORK_LOCK:
+      if os.getpid() != _PID:
+        AfterFork()
+
+
+_DEFAULT_CONTAINER = Container()
+
+multiprocessing.util.register_after_fork(_DEFAULT_CONTAINER,
+                                         lambda unused_container: _CheckFork())
+
+Inject = _DEFAULT_CONTAINER.Inject
+Injectable = _DEFAULT_CONTAINER.Injectable
+Scope = _DEFAULT_CONTAINER.Scope
+Warmup = _DEFAULT_CONTAINER.Warmup
+SaveWarmState = _DEFAULT_CONTAINER.SaveWarmState
+Validate = _DEFAULT_CONTAINER.Validate
+Compile = _DEFAULT_CONTAINER.Compile
+Freeze = _DEFAULT_CONTAINER.Freeze
+DumpInjectionStack = _DEFAULT_CONTAINER.DumpInjectionStack
+Capture = _DEFAULT_CONTAINER.Capture
+RunIn = _DEFAULT_CONTAINER.RunIn
+ExportInjections = _DEFAULT_CONTAINER.ExportInjections
+InstallInjections = _DEFAULT_CONTAINER.InstallInjections
+SetTestMode = _DEFAULT_CONTAINER.SetTestMode
+SetUpTestInjections = _DEFAULT_CONTAINER.SetUpTestInjections
+TearDownTestInjections = _DEFAULT_CONTAINER.TearDownTestInjections
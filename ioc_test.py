@@ -1,6 +1,11 @@
 #!/usr/bin/python
+import cPickle
+import functools
 import logging
+import os
 import sys
+import tempfile
+import time
 
 import ioc
 from jazz import jazz
@@ -12,6 +17,16 @@ if 'debug' in sys.argv:
   logging.getLogger().setLevel(logging.DEBUG)
 
 
+def ExportedGreeting():
+  """An importable injectable for ExportInjections."""
+  return 'Hello'
+
+
+def ExportedLock():
+  """An importable injectable which cannot be pickled."""
+  return ioc.threading.Lock()
+
+
 class Ioc(Describe):
 
   def before_each(self):
@@ -79,6 +94,25 @@ class Ioc(Describe):
     expect(ScopedFunc()).toEqual((32, 99))
     expect(InjectedFunc).toRaise(ioc.InjectionMissingError)
 
+  def it_should_isolate_interleaved_generator_scopes(self):
+
+    @ioc.Inject
+    def GetVal(val=ioc.IN):
+      return val
+
+    @ioc.Scope
+    def Handler(val):
+      ioc.Injectable.value(val=val)
+      yield GetVal()
+      yield GetVal()
+
+    first, second = Handler(1), Handler(2)
+    expect(next(first)).toBe(1)
+    expect(next(second)).toBe(2)
+    expect(GetVal).toRaise(ioc.InjectionMissingError)
+    expect(next(first)).toBe(1)
+    expect(next(second)).toBe(2)
+
   def it_should_support_multiple_threads(self):
 
     class T(ioc.threading.Thread):
@@ -93,6 +127,34 @@ class Ioc(Describe):
 
     expect(t.name).toEqual('baz')
 
+  def it_should_see_root_injectables_added_by_other_threads(self):
+
+    @ioc.Inject
+    def GetVal(val=ioc.IN):
+      return val
+
+    first_injection = ioc.threading.Event()
+    val_added = ioc.threading.Event()
+    results = []
+
+    def Run():
+      try:
+        GetVal()
+      except ioc.InjectionMissingError:
+        results.append('missing')
+      first_injection.set()
+      val_added.wait()
+      results.append(GetVal())
+
+    t = ioc.threading.Thread(target=Run)
+    t.start()
+    first_injection.wait()
+    ioc.Injectable.value(val='baz')
+    val_added.set()
+    t.join()
+
+    expect(results).toEqual(['missing', 'baz'])
+
   def it_should_support_the_main_thread_adding_scopes_for_children(self):
 
     class T(ioc.threading.Thread):
@@ -100,22 +162,284 @@ class Ioc(Describe):
       @ioc.Inject
       def run(self, bar=ioc.IN):
         self.setName(bar)
-        expect(len(ioc._MyScopes())).toBe(2)
+        expect(len(ioc._DEFAULT_CONTAINER._MyScopes())).toBe(2)
 
 
     @ioc.Scope
     def NewScope():
-      expect(len(ioc._MyScopes())).toBe(2)
+      expect(len(ioc._DEFAULT_CONTAINER._MyScopes())).toBe(2)
       ioc.Injectable.value(bar='baz')
       t = T()
       t.start()
       t.join()
       return t.name
 
-    expect(len(ioc._MyScopes())).toBe(1)
+    expect(len(ioc._DEFAULT_CONTAINER._MyScopes())).toBe(1)
     expect(NewScope()).toEqual('baz')
 
 
+  def it_should_run_callables_in_captured_scopes(self):
+
+    @ioc.Inject
+    def GetBar(bar=ioc.IN):
+      return bar
+
+    results = []
+
+    @ioc.Scope
+    def NewScope():
+      ioc.Injectable.value(bar='baz')
+      captured = ioc.Capture()
+      t = ioc.threading.Thread(
+          target=lambda: results.append(ioc.RunIn(captured, GetBar)))
+      t.start()
+      t.join()
+
+    t = ioc.threading.Thread(target=NewScope)
+    t.start()
+    t.join()
+
+    expect(results).toEqual(['baz'])
+    expect(GetBar).toRaise(ioc.InjectionMissingError)
+
+  def it_should_run_callables_in_scopes_left_since_the_capture(self):
+
+    @ioc.Inject
+    def GetBar(bar=ioc.IN):
+      return bar
+
+    @ioc.Scope
+    def NewScope(bar):
+      ioc.Injectable.value(bar=bar)
+      return ioc.Capture()
+
+    def Run():
+      captured = [NewScope('baz'), NewScope('qux')]
+      results.extend(ioc.RunIn(c, GetBar) for c in captured)
+
+    results = []
+    t = ioc.threading.Thread(target=Run)
+    t.start()
+    t.join()
+
+    expect(results).toEqual(['baz', 'qux'])
+
+  def it_should_keep_injectables_added_by_captured_callables_apart(self):
+
+    @ioc.Inject
+    def AddFoo(bar=ioc.IN):
+      ioc.Injectable.value(foo=bar)
+      return bar
+
+    @ioc.Scope
+    def NewScope():
+      ioc.Injectable.value(bar='baz')
+      captured = ioc.Capture()
+      results.append(ioc.RunIn(captured, AddFoo))
+      results.append(ioc.RunIn(captured, AddFoo))
+      results.append('foo' in ioc._DEFAULT_CONTAINER._CurrentScope())
+
+    results = []
+    NewScope()
+    expect(results).toEqual(['baz', 'baz', False])
+
+  def it_should_run_executor_tasks_in_the_submitting_scope(self):
+    if ioc.futures is None:
+      return  # The futures package is not installed.
+
+    @ioc.Inject
+    def GetBar(suffix, bar=ioc.IN):
+      return bar + suffix
+
+    @ioc.Scope
+    def NewScope(executor):
+      ioc.Injectable.value(bar='baz')
+      return executor.submit(GetBar, '!'), executor.map(GetBar, ['1', '2'])
+
+    with ioc.ScopedExecutor(max_workers=2) as executor:
+      future, results = NewScope(executor)
+      expect(future.result()).toEqual('baz!')
+      expect(executor.submit(lambda f, captured: f + captured, f=1,
+                             captured=2).result()).toBe(3)
+      expect(list(results)).toEqual(['baz1', 'baz2'])
+      expect(executor.submit(GetBar, '').result).toRaise(
+          ioc.InjectionMissingError)
+    expect(lambda: executor.submit(GetBar, '')).toRaise(RuntimeError)
+
+  def it_should_validate_missing_and_cyclic_injectables(self):
+
+    @ioc.Injectable
+    def foo(bar=ioc.IN):  # pylint: disable=unused-variable
+      return bar
+
+    @ioc.Injectable
+    def bar(foo=ioc.IN, baz=ioc.IN):  # pylint: disable=unused-variable
+      return foo, baz
+
+    try:
+      ioc.Validate()
+    except ioc.InjectionGraphError as e:
+      errors = str(e).splitlines()
+    expect(errors).toEqual([
+        "Injectable 'bar' requires 'baz', which was not found.",
+        "Injectables depend on each other in a cycle: 'bar' -> 'foo' -> 'bar'.",
+    ])
+
+  def it_should_validate_injectables_provided_by_scopes(self):
+    # pylint: disable=unused-variable
+
+    @ioc.Injectable
+    def user(params=ioc.IN):
+      return params['user']
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def greeting(user=ioc.IN):
+      return 'Hello %s' % user
+
+    expect(ioc.Validate).toRaise(ioc.InjectionGraphError)
+    expect(lambda: ioc.Validate(provided=('params',))).notToRaise(
+        ioc.InjectionGraphError)
+    graph = ioc.Compile(provided=('params',))
+    expect(graph.order).toEqual(('user', 'greeting'))
+    expect(graph.dep_scopes).toEqual({})
+
+  def it_should_compile_the_injection_graph(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo(bar=ioc.IN):  # pylint: disable=unused-variable
+      return bar
+
+    @ioc.Injectable
+    def bar(baz=ioc.LAZY):  # pylint: disable=unused-variable
+      return baz
+
+    @ioc.Injectable
+    def baz(foo=ioc.IN):  # pylint: disable=unused-variable
+      return foo
+
+    graph = ioc.Compile()
+    expect(graph.order).toEqual(('bar', 'foo', 'baz'))
+    expect(graph.dependencies['baz']).toEqual(('foo',))
+    expect(graph.dep_scopes).toEqual({'foo': ioc._DEFAULT_CONTAINER.root})
+
+  def it_should_keep_compiled_dependencies_in_request_scopes(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo(bar=ioc.IN):  # pylint: disable=unused-variable
+      return bar
+
+    @ioc.Scope
+    def Request():
+      ioc.Injectable.value(params='me')
+      scope_map = ioc._DEFAULT_CONTAINER._GetInjectionScopeMap()
+      return ('bar',) in scope_map.dependencies
+
+    ioc.Injectable.value(bar=42)
+    ioc.Compile()
+    expect(Request()).toBe(True)
+
+  def it_should_isolate_containers(self):
+    container = ioc.Container()
+
+    @container.Injectable
+    @ioc.Singleton
+    def foo():  # pylint: disable=unused-variable
+      return []
+
+    ioc.Injectable.value(foo='default')
+
+    def GetFoo(foo=ioc.IN):
+      return foo
+
+    @container.Scope
+    def GetFooInScope():
+      container.Injectable.value(foo='scoped')
+      return container.Inject(GetFoo)(), ioc.Inject(GetFoo)()
+
+    expect(container.Inject(GetFoo)()).toEqual([])
+    expect(container.Inject(GetFoo)()).toBe(container.Inject(GetFoo)())
+    expect(ioc.Inject(GetFoo)()).toEqual('default')
+    expect(GetFooInScope()).toEqual(('scoped', 'default'))
+
+  def it_should_share_main_thread_scopes_of_containers_made_elsewhere(self):
+    containers = []
+    worker = ioc.threading.Thread(
+        target=lambda: containers.append(ioc.Container()))
+    worker.start()
+    worker.join()
+    container = containers[0]
+    seen = []
+
+    @container.Scope
+    def StartThread():
+      container.Injectable.value(foo='main')
+      thread = ioc.threading.Thread(
+          target=lambda: seen.append(container.Inject(lambda foo=ioc.IN: foo)()))
+      thread.start()
+      thread.join()
+
+    StartThread()
+    expect(seen).toEqual(['main'])
+
+  def it_should_report_sentinels_used_in_test_mode_of_any_container(self):
+    container = ioc.Container()
+    container.SetTestMode()
+
+    def NotInjected(foo=ioc.IN):
+      return len(foo)
+
+    expect(NotInjected).toRaise(ioc.TestInjectionsNotSetupError)
+
+  def it_should_inject_callables_decorated_before_a_reload(self):
+
+    @ioc.Inject
+    def GetBar(bar=ioc.IN):
+      return bar
+
+    @ioc.Scope
+    def ScopedGetBar():
+      ioc.Injectable.value(bar='scoped')
+      return GetBar()
+
+    class Foo(object):
+
+      def __init__(self, bar=ioc.IN):
+        self.bar = bar
+
+    ioc.Injectable(Foo)
+    reload(ioc)
+    ioc.Injectable.value(bar='baz')
+    expect(GetBar()).toEqual('baz')
+    expect(ScopedGetBar()).toEqual('scoped')
+    expect(Foo().bar).toEqual('baz')
+
+    ioc.SetTestMode()
+    expect(GetBar).toRaise(ioc.TestInjectionsNotSetupError)
+    ioc.SetUpTestInjections(bar='test')
+    expect(GetBar()).toEqual('test')
+
+  def it_should_inject_classes_from_each_container_registering_them(self):
+
+    class Service(object):
+
+      def __init__(self, tenant=ioc.IN):
+        self.tenant = tenant
+
+    containers = ioc.Container(), ioc.Container()
+    for container, tenant in zip(containers, ('a', 'b')):
+      container.Injectable.value(tenant=tenant)
+      container.Injectable(Service)
+
+    def GetTenant(Service=ioc.IN):  # pylint: disable=invalid-name
+      return Service.tenant
+
+    expect([c.Inject(GetTenant)() for c in containers]).toEqual(['a', 'b'])
+    expect(isinstance(containers[1].Inject(lambda Service=ioc.IN: Service)(),
+                      Service)).toBe(True)
+
   def it_should_tolerate_layering_injection_wrappers(self):
 
     def InjectInjectable():
@@ -143,6 +467,38 @@ class Ioc(Describe):
 
     expect(foo(val=99)).toBe(99)
 
+  def it_should_provide_injectable_values_without_wrapping_them(self):
+
+    @ioc.Inject
+    def GetFoo(foo=ioc.IN, lazy_foo=ioc.LAZY):
+      return foo, lazy_foo
+
+    foo = object()
+    ioc.Injectable.value(foo=foo)
+    ioc.Injectable.value(lazy_foo=42)
+    root = ioc._DEFAULT_CONTAINER.root
+    expect(root['foo'].__class__).toBe(ioc._ConstantProvider)
+    expect(GetFoo()[0]).toBe(foo)
+    expect(GetFoo()[1] + 1).toBe(43)
+
+  def it_should_support_injectable_values_in_batches(self):
+
+    @ioc.Inject
+    def GetVals(foo=ioc.IN, bar=ioc.IN, baz=ioc.IN):
+      return foo, bar, baz
+
+    ioc.Injectable.values({'foo': 1, 'bar': 2})
+    ioc.Injectable.update(baz=3)
+    expect(GetVals()).toEqual((1, 2, 3))
+
+    def UpdateConflicting():
+      ioc.Injectable.update(qux=4, foo=5)
+
+    expect(UpdateConflicting).toRaise(ValueError)
+    expect(GetVals()).toEqual((1, 2, 3))
+    expect(ioc.Inject(lambda qux=ioc.IN: qux)).toRaise(
+        ioc.InjectionMissingError)
+
   def it_should_detect_name_conflict_in_same_scope(self):
 
     def InjectValue():
@@ -166,6 +522,51 @@ class Ioc(Describe):
     expect(GetVal()).toBe(42)
     expect(ScopedFunc()).toBe(32)
 
+  def it_should_restore_shadowed_injectables_when_leaving_scopes(self):
+    ioc.Injectable.value(val=1)
+
+    @ioc.Inject
+    def GetVal(val=ioc.IN):
+      return val
+
+    @ioc.Scope
+    def InnerScope():
+      ioc.Injectable.value(val=3)
+      return GetVal()
+
+    @ioc.Scope
+    def OuterScope():
+      ioc.Injectable.value(val=2)
+      return InnerScope(), GetVal()
+
+    expect(GetVal()).toBe(1)
+    expect(OuterScope()).toEqual((3, 2))
+    expect(GetVal()).toBe(1)
+
+  def it_should_keep_dependencies_of_names_scopes_do_not_shadow(self):
+    container = ioc._DEFAULT_CONTAINER
+    ioc.Injectable.value(val=1)
+
+    @ioc.Injectable
+    def user(params=ioc.IN):  # pylint: disable=unused-variable
+      return params
+
+    def CachedDependencies():
+      return sorted(container._GetInjectionScopeMap().dependencies)
+
+    @ioc.Scope
+    def Request():
+      ioc.Injectable.value(params='me')
+      cached = CachedDependencies()
+      expect(container._GetTransitiveInjections(('user',))).toEqual(
+          frozenset(['user', 'params']))
+      return cached
+
+    container._GetTransitiveInjections(('val',))
+    container._GetTransitiveInjections(('user',))
+    expect(Request()).toEqual([('val',)])
+    expect(CachedDependencies()).toEqual([('val',)])
+
   def it_should_require_all_injections(self):
 
     @ioc.Inject
@@ -180,6 +581,240 @@ class Ioc(Describe):
       return val
     expect(Injected(val=42)).toEqual(42)
 
+  def it_should_resolve_injectables_added_after_injecting(self):
+
+    @ioc.Inject
+    def Injected(val=ioc.IN):
+      return val
+    expect(Injected).toRaise(ioc.InjectionMissingError)
+    ioc.Injectable.value(val=42)
+    expect(Injected()).toBe(42)
+
+  def it_should_keep_the_signature_of_injected_functions(self):
+    ioc.Injectable.value(bar='bar')
+
+    @ioc.Inject
+    def foo(baz, bar=ioc.IN, *args, **kwargs):
+      return baz, bar, args, kwargs
+
+    expect(ioc.inspect.getargspec(foo).args).toEqual(['baz', 'bar'])
+    expect(foo(1)).toEqual((1, 'bar', (), {}))
+    expect(foo(1, 2, 3, cat=4)).toEqual((1, 2, (3,), {'cat': 4}))
+
+  def it_should_defer_lazy_injections_until_used(self):
+    calls = []
+
+    @ioc.Injectable
+    def expensive():  # pylint: disable=unused-variable
+      calls.append(1)
+      return {'key': 'value'}
+
+    @ioc.Inject
+    def Lookup(cached, expensive=ioc.LAZY):
+      if cached:
+        return cached
+      return expensive['key']
+
+    expect(Lookup('cached')).toEqual('cached')
+    expect(calls).toEqual([])
+    expect(Lookup(None)).toEqual('value')
+    expect(calls).toEqual([1])
+
+  def it_should_create_singletons_with_missing_lazy_injections(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def cache(db=ioc.LAZY):  # pylint: disable=unused-variable
+      return {'db': db}
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def index(cache=ioc.IN, missing=ioc.IN):  # pylint: disable=unused-variable
+      return cache, missing
+
+    cache = ioc.Inject(lambda cache=ioc.IN: cache)()
+    expect(ioc.Inject(lambda cache=ioc.IN: cache)()).toBe(cache)
+    expect(ioc.Inject(lambda index=ioc.IN: index)).toRaise(ValueError)
+
+  def it_should_swap_in_traced_wrappers(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo():  # pylint: disable=unused-variable
+      return object()
+
+    @ioc.Inject
+    def bar(foo=ioc.IN):
+      return foo
+
+    code = bar.__code__
+    untraced = bar()
+    ioc.SetTracing()
+    expect(bar.__code__).notToBe(code)
+    expect(bar()).toBe(untraced)
+    ioc.SetTracing(False)
+    expect(bar.__code__).toBe(code)
+    expect(bar()).toBe(untraced)
+
+  def it_should_reject_root_injectables_once_frozen(self):
+    ioc.Freeze()
+
+    def InjectValue():
+      ioc.Injectable.value(val=42)
+    expect(InjectValue).toRaise(ioc.ScopeFrozenError)
+
+  def it_should_inject_from_a_frozen_root(self):
+    ioc.Injectable.value(val=42)
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo():  # pylint: disable=unused-variable
+      return object()
+
+    @ioc.Inject
+    def GetVals(foo=ioc.IN, val=ioc.IN):
+      return foo, val
+
+    @ioc.Scope
+    def ScopedFunc():
+      ioc.Injectable.value(val=32)
+      return GetVals()
+
+    foo, _ = GetVals()
+    ioc.Freeze()
+    expect(GetVals()).toEqual((foo, 42))
+    expect(ScopedFunc()).toEqual((foo, 32))
+    expect(GetVals()).toEqual((foo, 42))
+
+  def it_should_profile_injections(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo(bar=ioc.IN):  # pylint: disable=unused-variable
+      return bar
+
+    @ioc.Inject
+    def GetFoo(foo=ioc.IN):
+      return foo
+
+    ioc.Injectable.value(bar=42)
+    ioc.StartProfiling()
+    GetFoo()
+    GetFoo()
+    ioc.StopProfiling()
+    GetFoo()
+
+    foo_stats = ioc.GetProfile()['providers']['Root']['foo']
+    expect(foo_stats['calls']).toBe(2)
+    expect(foo_stats['singleton_misses']).toBe(1)
+    expect(foo_stats['singleton_hits']).toBe(1)
+    expect(ioc.GetCollapsedProfile().splitlines()[1].split()[0]).toEqual(
+        'foo@Root;bar@Root')
+
+  def it_should_profile_singletons_under_the_scope_providing_them(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def foo(bar=ioc.IN):  # pylint: disable=unused-variable
+      return bar
+
+    @ioc.Inject
+    def GetFoo(foo=ioc.IN):
+      return foo
+
+    @ioc.Scope
+    def Request():
+      ioc.Injectable.value(bar=42)  # foo attaches to the request scope.
+      GetFoo()
+      GetFoo()
+
+    ioc.StartProfiling()
+    Request()
+    ioc.StopProfiling()
+
+    providers = ioc.GetProfile()['providers']
+    expect([name for name in providers if 'foo' in providers[name]]).toEqual(
+        ['Root'])
+    foo_stats = providers['Root']['foo']
+    expect(foo_stats['calls']).toBe(2)
+    expect(foo_stats['singleton_misses']).toBe(1)
+    expect(foo_stats['singleton_hits']).toBe(1)
+
+  def it_should_reinstall_exported_recipes(self):
+    ioc.Injectable(ExportedGreeting)
+    exported = ioc.ExportInjections()
+    expect(exported).toEqual({
+        'values': {}, 'recipes': {'ExportedGreeting': (__name__,
+                                                       'ExportedGreeting')}})
+
+    reload(ioc)
+    ioc.InstallInjections(exported)
+
+    @ioc.Inject
+    def Greet(ExportedGreeting=ioc.IN):  # pylint: disable=invalid-name
+      return ExportedGreeting
+    expect(Greet()).toEqual('Hello')
+
+  def it_should_export_recipes_of_frozen_root_singletons(self):
+    ioc.Injectable(ioc.Singleton(ExportedLock))
+    lock = ioc.Inject(lambda ExportedLock=ioc.IN: ExportedLock)()
+    ioc.Freeze()
+
+    exported = ioc.ExportInjections()
+    expect(exported).toEqual({
+        'values': {}, 'recipes': {'ExportedLock': (__name__, 'ExportedLock')}})
+    expect(lambda: cPickle.dumps(exported)).notToRaise()
+
+    reload(ioc)
+    ioc.InstallInjections(exported)
+    expect(ioc.Inject(lambda ExportedLock=ioc.IN: ExportedLock)()).notToBe(
+        lock)
+
+  def it_should_provide_old_style_classes(self):
+
+    class Foo:  # pylint: disable=old-style-class
+
+      def __init__(self, bar=ioc.IN):
+        self.bar = bar
+
+    ioc.Injectable.value(bar=42)
+    ioc.Injectable(Foo)
+    expect(ioc.Inject(lambda Foo=ioc.IN: Foo.bar)()).toBe(42)
+
+  def it_should_inject_bound_methods_and_classmethods(self):
+
+    class Foo(object):
+
+      def Get(self, bar=ioc.IN):
+        return self, bar
+
+      @classmethod
+      def GetClass(cls, bar=ioc.IN):
+        return cls, bar
+
+    ioc.Injectable.value(bar=42)
+    foo = Foo()
+    expect(ioc.Inject(foo.Get)()).toEqual((foo, 42))
+    expect(ioc.Inject(Foo.GetClass)()).toEqual((Foo, 42))
+
+  def it_should_install_exported_injections(self):
+    ioc.Injectable.value(val=42)
+
+    @ioc.Injectable
+    def nested():  # pylint: disable=unused-variable
+      return 'Not importable'
+
+    exported = ioc.ExportInjections()
+    expect(exported).toEqual({'values': {'val': 42}, 'recipes': {}})
+
+    reload(ioc)
+    ioc.InstallInjections(exported)
+
+    @ioc.Inject
+    def GetVal(val=ioc.IN):
+      return val
+    expect(GetVal()).toBe(42)
+
   def it_should_not_mangle_classes(self):
 
     @ioc.Inject
@@ -391,6 +1026,576 @@ class IocSingleton(Describe):
     expect(ReturnSingleton()).toBe(ReturnSingleton())
     expect(ReturnSingleton().val).toBe(val)
 
+  def it_should_create_singletons_once_for_concurrent_injections(self):
+    created = []
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def singleton():  # pylint: disable=unused-variable
+      created.append(object())
+      time.sleep(0.01)
+      return created[-1]
+
+    class T(ioc.threading.Thread):
+      @ioc.Inject
+      def run(self, singleton=ioc.IN):
+        self.singleton = singleton
+
+    threads = [T() for _ in range(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    expect(len(created)).toBe(1)
+    for t in threads:
+      expect(t.singleton).toBe(created[0])
+
+  def it_should_attach_singletons_with_diamond_dependencies(self):
+    # pylint: disable=unused-variable
+
+    @ioc.Injectable
+    def left(base=ioc.IN):
+      return base
+
+    @ioc.Injectable
+    def right(base=ioc.IN):
+      return base
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def top(left=ioc.IN, right=ioc.IN):
+      return left + right
+
+    @ioc.Inject
+    def GetTop(top=ioc.IN):
+      return top
+
+    @ioc.Scope
+    def ScopedFunc():
+      ioc.Injectable.value(base=1)
+      return GetTop()
+
+    expect(ScopedFunc()).toBe(2)
+    # top should have been popped with the scope providing base.
+    expect(GetTop).toRaise(ValueError)
+
+  def it_should_share_singleton_futures_until_they_fail(self):
+    if ioc.futures is None:
+      return  # The futures package is not installed.
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def connection():  # pylint: disable=unused-variable
+      return ioc.futures.Future()
+
+    get_connection = ioc.Inject(lambda connection=ioc.IN: connection)
+    first = get_connection()
+    expect(get_connection()).toBe(first)
+    first.set_exception(IOError('Connection refused.'))
+    second = get_connection()
+    expect(second).notToBe(first)
+    second.set_result('connected')
+    expect(get_connection()).toBe(second)
+
+  def it_should_create_scoped_injectables_once_per_scope(self):
+    tokens = []
+
+    @ioc.Injectable
+    @ioc.Scoped
+    def principal(token=ioc.IN):  # pylint: disable=unused-variable
+      tokens.append(token)
+      return object()
+
+    @ioc.Inject
+    def GetPrincipal(principal=ioc.IN):
+      return principal
+
+    @ioc.Scope
+    def Request(token):
+      ioc.Injectable.value(token=token)
+      expect(GetPrincipal()).toBe(GetPrincipal())
+      return GetPrincipal()
+
+    expect(Request('a')).notToBe(Request('b'))
+    expect(tokens).toEqual(['a', 'b'])
+
+  def it_should_not_share_singletons_of_functions_with_the_same_name(self):
+
+    def CreateProvider(value):
+      @ioc.Singleton
+      def provider():
+        return value
+      return provider
+
+    ioc.Injectable.named('foo')(CreateProvider('foo'))
+    ioc.Injectable.named('bar')(CreateProvider('bar'))
+
+    @ioc.Inject
+    def GetSingletons(foo=ioc.IN, bar=ioc.IN):
+      return foo, bar
+
+    expect(GetSingletons()).toEqual(('foo', 'bar'))
+
+  def it_should_reuse_singletons_added_by_every_scope_run(self):
+    created = []
+    ioc.Injectable.value(val=1)
+
+    @ioc.Inject
+    def GetSingleton(singleton=ioc.IN):
+      return singleton
+
+    @ioc.Scope
+    def Request():
+
+      @ioc.Injectable
+      @ioc.Singleton
+      def singleton(val=ioc.IN):  # pylint: disable=unused-variable
+        created.append(val)
+        return object()
+
+      return GetSingleton()
+
+    first = Request()
+    expect(Request()).toBe(first)
+    expect(Request()).toBe(first)
+    expect(created).toEqual([1])
+    root = ioc._DEFAULT_CONTAINER.root
+    expect(len(root.singletons)).toBe(1)
+    expect(len(root._singleton_locks)).toBe(1)
+
+  def it_should_reuse_singletons_added_by_every_run_of_a_task(self):
+    created = []
+
+    @ioc.Inject
+    def GetClient(client=ioc.IN):
+      return client
+
+    def Task(unused_n):
+
+      @ioc.Injectable
+      @ioc.Singleton
+      def client():  # pylint: disable=unused-variable
+        created.append(1)
+        return object()
+
+      return GetClient()
+
+    captured = ioc.Capture()
+    first = ioc.RunIn(captured, Task, 1)
+    expect(ioc.RunIn(captured, Task, 2)).toBe(first)
+    expect(ioc.RunIn(captured, functools.partial(Task, 3))).toBe(first)
+    expect(created).toEqual([1])
+    # pylint: disable=protected-access
+    root = ioc._DEFAULT_CONTAINER.root
+    expect(len(root.singletons)).toBe(1)
+    expect(len(root._singleton_locks)).toBe(1)
+
+  def it_should_dispose_singletons_when_leaving_their_scope(self):
+    disposed = []
+
+    @ioc.Inject
+    def GetConnection(connection=ioc.IN):
+      return connection
+
+    @ioc.Scope
+    def Request(user):
+      ioc.Injectable.value(user=user)
+
+      @ioc.Injectable
+      @ioc.Singleton(dispose=disposed.append)
+      def connection(user=ioc.IN):  # pylint: disable=unused-variable
+        return 'connection of %s' % user
+
+      expect(GetConnection()).toBe(GetConnection())
+      expect(disposed).toEqual([])
+
+    Request('me')
+    expect(disposed).toEqual(['connection of me'])
+
+  def it_should_dispose_singletons_created_after_their_scope_was_left(self):
+    disposed = []
+
+    @ioc.Inject
+    def GetConnection(connection=ioc.IN):
+      return connection
+
+    @ioc.Scope
+    def Request(user):
+      ioc.Injectable.value(user=user)
+
+      @ioc.Injectable
+      @ioc.Singleton(dispose=disposed.append)
+      def connection(user=ioc.IN):  # pylint: disable=unused-variable
+        return 'connection of %s' % user
+
+      return ioc.Capture()
+
+    captured = Request('me')
+    expect(ioc.RunIn(captured, GetConnection)).toEqual('connection of me')
+    expect(disposed).toEqual(['connection of me'])
+
+  def it_should_recreate_singletons_after_their_ttl(self):
+    disposed = []
+
+    @ioc.Injectable
+    @ioc.Singleton(ttl=60, dispose=disposed.append)
+    def singleton():  # pylint: disable=unused-variable
+      return object()
+
+    @ioc.Inject
+    def ReturnSingleton(singleton=ioc.IN):
+      return singleton
+
+    # pylint: disable=protected-access
+    root = ioc._DEFAULT_CONTAINER.root
+    first = ReturnSingleton()
+    expect(ReturnSingleton()).toBe(first)
+    root._managed[root['singleton'].ioc_singleton_key].expires = time.time() - 1
+    expect(ReturnSingleton()).notToBe(first)
+    expect(disposed).toEqual([first])
+
+  def it_should_dispose_expired_singletons_once_their_lock_is_free(self):
+    # pylint: disable=protected-access
+    root = ioc._DEFAULT_CONTAINER.root
+    key = ioc._ProviderKey('singleton')
+    locked = []
+
+    def Dispose(unused_singleton):
+      lock = root._GetLock(key)
+      acquired = []
+
+      def TryLock():
+        acquired.append(lock.acquire(False))
+        if acquired[0]:
+          lock.release()
+
+      t = ioc.threading.Thread(target=TryLock)
+      t.start()
+      t.join()
+      locked.append(not acquired[0])
+
+    policy = ioc.SingletonPolicy(ttl=60, dispose=Dispose)
+    first = root.CreateManagedSingleton(key, policy, object)
+    root._managed[key].expires = time.time() - 1
+    expect(root.CreateManagedSingleton(key, policy, object)).notToBe(first)
+    expect(locked).toEqual([False])
+
+  def it_should_evict_least_recently_injected_singletons(self):
+    disposed = []
+    policy = ioc.SingletonPolicy(max_size=2, dispose=disposed.append)
+
+    @ioc.Injectable
+    @ioc.Singleton(policy=policy)
+    def foo():  # pylint: disable=unused-variable
+      return 'foo'
+
+    @ioc.Injectable
+    @ioc.Singleton(policy=policy)
+    def bar():  # pylint: disable=unused-variable
+      return 'bar'
+
+    @ioc.Injectable
+    @ioc.Singleton(policy=policy)
+    def baz():  # pylint: disable=unused-variable
+      return 'baz'
+
+    getters = {
+        'foo': ioc.Inject(lambda foo=ioc.IN: foo),
+        'bar': ioc.Inject(lambda bar=ioc.IN: bar),
+        'baz': ioc.Inject(lambda baz=ioc.IN: baz),
+    }
+    for name in ('foo', 'bar', 'foo', 'baz'):
+      expect(getters[name]()).toEqual(name)
+    expect(disposed).toEqual(['bar'])
+
+  def it_should_refresh_singletons_in_the_background(self):
+    builds = []
+    rebuild = ioc.threading.Event()
+
+    @ioc.Injectable
+    @ioc.Singleton.refreshing(interval=0)
+    def flags():  # pylint: disable=unused-variable
+      if builds:
+        rebuild.wait()
+      builds.append(len(builds) + 1)
+      return builds[-1]
+
+    get_flags = ioc.Inject(lambda flags=ioc.IN: flags)
+    expect(get_flags()).toBe(1)
+    expect(get_flags()).toBe(1)  # Does not wait for the refresh.
+    rebuild.set()
+    while get_flags() == 1:
+      time.sleep(0.01)
+    expect(get_flags()).notToBe(1)
+
+  def it_should_wait_for_refreshing_singletons_once_too_stale(self):
+    builds = []
+
+    @ioc.Injectable
+    @ioc.Singleton.refreshing(interval=0, stale_ok=0)
+    def flags():  # pylint: disable=unused-variable
+      builds.append(len(builds) + 1)
+      return builds[-1]
+
+    get_flags = ioc.Inject(lambda flags=ioc.IN: flags)
+    expect([get_flags(), get_flags(), get_flags()]).toEqual([1, 2, 3])
+
+  def it_should_wait_an_interval_after_failed_background_refreshes(self):
+    calls = []
+    root = ioc._DEFAULT_CONTAINER.root
+
+    @ioc.Injectable
+    @ioc.Singleton.refreshing(interval=0.2)
+    def flags():  # pylint: disable=unused-variable
+      calls.append(None)
+      if len(calls) == 2:
+        raise IOError('Flags are unavailable.')
+      return len(calls)
+
+    def WaitForRefreshes():
+      while root._refreshing:  # pylint: disable=protected-access
+        time.sleep(0.01)
+
+    get_flags = ioc.Inject(lambda flags=ioc.IN: flags)
+    expect(get_flags()).toBe(1)
+    time.sleep(0.2)
+    expect(get_flags()).toBe(1)  # Starts the failing refresh.
+    WaitForRefreshes()
+    for _ in range(10):
+      expect(get_flags()).toBe(1)
+      WaitForRefreshes()
+    expect(len(calls)).toBe(2)
+    time.sleep(0.2)
+    get_flags()
+    WaitForRefreshes()
+    expect(len(calls)).toBe(3)
+    expect(get_flags()).toBe(3)
+
+  def it_should_share_concurrent_calls_of_single_flight_injectables(self):
+    calls = []
+    started = ioc.threading.Event()
+    release = ioc.threading.Event()
+
+    @ioc.Injectable
+    @ioc.SingleFlight
+    def table():  # pylint: disable=unused-variable
+      calls.append(None)
+      started.set()
+      release.wait()
+      return object()
+
+    get_table = ioc.Inject(lambda table=ioc.IN: table)
+    results = []
+    threads = [ioc.threading.Thread(target=lambda: results.append(get_table()))
+               for _ in range(3)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+      thread.start()
+    time.sleep(0.02)
+    release.set()
+    for thread in threads:
+      thread.join()
+
+    expect(len(calls)).toBe(1)
+    expect(results).toEqual([results[0]] * 3)
+    expect(get_table()).notToBe(results[0])
+    expect(len(calls)).toBe(2)
+
+  def it_should_not_share_single_flight_calls_missing_injections(self):
+
+    @ioc.Injectable
+    @ioc.SingleFlight
+    def table(rows=ioc.IN):  # pylint: disable=unused-variable
+      return rows
+
+    @ioc.Injectable
+    @ioc.SingleFlight
+    def index(rows=ioc.LAZY):  # pylint: disable=unused-variable,unused-argument
+      return 'index'
+
+    expect(ioc.Inject(lambda table=ioc.IN: table)).toRaise(
+        ioc.InjectionMissingError)
+    expect(ioc.Inject(lambda index=ioc.IN: index)()).toEqual('index')
+
+  def it_should_warm_up_singletons_from_a_snapshot(self):
+    path = os.path.join(tempfile.mkdtemp(), 'warm_state')
+    builds = []
+    versions = {'routes': 1}
+
+    def SetUp():
+      reload(ioc)
+
+      @ioc.Injectable
+      @ioc.Singleton.eager(fingerprint=lambda: versions['routes'])
+      def routes():  # pylint: disable=unused-variable
+        builds.append('routes')
+        return {'/': 'index'}
+
+      @ioc.Injectable
+      @ioc.Singleton.eager(fingerprint=1)
+      def paths(routes=ioc.IN):  # pylint: disable=unused-variable
+        builds.append('paths')
+        return sorted(routes)
+
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    ioc.SaveWarmState(path)
+    expect(builds).toEqual(['routes', 'paths'])
+
+    del builds[:]
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    expect(builds).toEqual([])
+    expect(ioc.Inject(lambda paths=ioc.IN: paths)()).toEqual(['/'])
+
+    versions['routes'] = 2  # Rebuilds the dependent paths as well.
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    expect(builds).toEqual(['routes', 'paths'])
+
+  def it_should_not_restore_singletons_saved_with_scoped_injectables(self):
+    path = os.path.join(tempfile.mkdtemp(), 'warm_state')
+    builds = []
+
+    def SetUp():
+      reload(ioc)
+
+      @ioc.Injectable
+      @ioc.Singleton.eager(fingerprint=1)
+      def routes():  # pylint: disable=unused-variable
+        builds.append('routes')
+        return {'/': 'index'}
+
+      @ioc.Injectable
+      @ioc.Singleton(fingerprint=1)
+      def page(params=ioc.IN):  # pylint: disable=unused-variable
+        builds.append('page')
+        return params['page']
+
+      @ioc.Scope
+      def Request(params):
+        ioc.Injectable.value(params=params)
+        page = ioc.Inject(lambda page=ioc.IN: page)()
+        ioc.SaveWarmState(path)  # Saves the page of the request as well.
+        return page
+
+      return Request
+
+    Request = SetUp()
+    ioc.Warmup()
+    expect(Request({'page': 1})).toEqual(1)
+    expect(builds).toEqual(['routes', 'page'])
+
+    del builds[:]
+    Request = SetUp()
+    ioc.Warmup(from_snapshot=path)
+    expect(builds).toEqual([])
+    expect(Request({'page': 2})).toEqual(2)
+    expect(builds).toEqual(['page'])
+
+  def it_should_save_singletons_of_a_frozen_root(self):
+    path = os.path.join(tempfile.mkdtemp(), 'warm_state')
+    builds = []
+
+    def SetUp():
+      reload(ioc)
+
+      @ioc.Injectable
+      @ioc.Singleton.eager(fingerprint=1)
+      def routes():  # pylint: disable=unused-variable
+        builds.append('routes')
+        return {'/': 'index'}
+
+    SetUp()
+    ioc.Warmup()
+    ioc.Freeze()
+    ioc.SaveWarmState(path)
+
+    del builds[:]
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    expect(builds).toEqual([])
+    expect(ioc.Inject(lambda routes=ioc.IN: routes)()).toEqual({'/': 'index'})
+
+  def it_should_restore_refreshing_singletons_from_a_snapshot(self):
+    path = os.path.join(tempfile.mkdtemp(), 'warm_state')
+    builds = []
+
+    def SetUp():
+      reload(ioc)
+
+      @ioc.Injectable
+      @ioc.Singleton.refreshing(interval=60)
+      @ioc.Singleton.eager(fingerprint=1)
+      def flags():  # pylint: disable=unused-variable
+        builds.append('flags')
+        return {'beta': True}
+
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    ioc.SaveWarmState(path)
+
+    del builds[:]
+    SetUp()
+    ioc.Warmup(from_snapshot=path)
+    expect(ioc.Inject(lambda flags=ioc.IN: flags)()).toEqual({'beta': True})
+    expect(builds).toEqual([])
+
+  def it_should_drop_frozen_singletons_after_fork(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def singleton():  # pylint: disable=unused-variable
+      return object()
+
+    get_singleton = ioc.Inject(lambda singleton=ioc.IN: singleton)
+    parent = get_singleton()
+    ioc.Freeze()
+    expect(get_singleton()).toBe(parent)
+
+    ioc.AfterFork()
+    child = get_singleton()
+    expect(child).notToBe(parent)
+    expect(get_singleton()).toBe(child)
+
+  def it_should_drop_singletons_after_fork(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def singleton():  # pylint: disable=unused-variable
+      return object()
+
+    @ioc.Inject
+    def ReturnSingleton(singleton=ioc.IN):
+      return singleton
+
+    parent_singleton = ReturnSingleton()
+    ioc.AfterFork()
+    expect(ReturnSingleton()).notToBe(parent_singleton)
+    expect(ReturnSingleton()).toBe(ReturnSingleton())
+
+  def it_should_drop_singletons_in_forked_children(self):
+
+    @ioc.Injectable
+    @ioc.Singleton
+    def singleton():  # pylint: disable=unused-variable
+      return os.getpid()
+
+    get_singleton = ioc.Inject(lambda singleton=ioc.IN: singleton)
+    expect(get_singleton()).toEqual(os.getpid())
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      ioc.AfterFork()
+      os.write(write_fd, str(get_singleton()))
+      os._exit(0)  # pylint: disable=protected-access
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    expect(int(os.read(read_fd, 32))).toEqual(pid)
+    os.close(read_fd)
+
   def it_should_support_eager_singletons(self):
     spy = create_spy('eager')
 
@@ -407,6 +1612,41 @@ class IocSingleton(Describe):
     ReturnSingleton()
     expect(spy.call_count).toBe(1)
 
+  def it_should_warm_up_eager_singletons_in_dependency_order(self):
+    # pylint: disable=unused-variable
+    spans = {}
+
+    def Record(name, seconds):
+      start = time.time()
+      time.sleep(seconds)
+      spans[name] = (start, time.time())
+
+    @ioc.Injectable
+    @ioc.Singleton.eager
+    def pool():
+      Record('pool', 0.05)
+
+    @ioc.Injectable
+    def connection(pool=ioc.IN):
+      return pool
+
+    # Only resolves pool once used, so just the warm up order makes it wait.
+    @ioc.Injectable
+    @ioc.Singleton.eager
+    def cache(connection=ioc.LAZY):
+      Record('cache', 0)
+
+    @ioc.Injectable
+    @ioc.Singleton.eager
+    def config():
+      Record('config', 0.05)
+
+    timings = ioc.Warmup(parallel=3)
+    expect(sorted(timings)).toEqual(['cache', 'config', 'pool'])
+    expect(spans['config'][0] < spans['pool'][1]).toBe(True)
+    expect(spans['pool'][0] < spans['config'][1]).toBe(True)
+    expect(spans['cache'][0] >= spans['pool'][1]).toBe(True)
+
 
   class ScopedSingletonClass(Describe):
 